@@ -69,35 +69,51 @@ def detect_location(ip, user_id):
 
 
 @spool(pass_arguments=True)
-def verification_email(user):
+def verification_email(user_id):
     from biostar.accounts import auth
+    from biostar.accounts.models import User
 
-    auth.send_verification_email(user=user)
+    user = User.objects.filter(id=user_id).first()
+    if user:
+        auth.send_verification_email(user=user)
     return
 
 
-@spool(pass_arguments=True)
+def default_sender():
+    """
+    Returns the user that sends the site messages, an admin with an account or else a superuser.
+    """
+    from biostar.accounts.models import User
+
+    emails = [email for name, email in settings.ADMINS]
+    return User.objects.filter(email__in=emails).first() or User.objects.filter(is_superuser=True).first()
+
+
 def create_messages(template, rec_list, sender=None, extra_context={}):
     """
     Create batch message from sender to a given recipient_list
     """
-    from biostar.accounts.models import User, Message, MessageBody
+    from biostar.accounts.models import Message, MessageBody
+    from biostar.accounts import util
+
+    sender = sender or default_sender()
+
+    # Messages are created while saving users, a missing sender must not stop that.
+    if not sender:
+        return []
 
-    # Get the sender
-    name, email = settings.ADMINS[0]
-    sender = sender or User.objects.filter(email=email).first() or User.objects.filter(is_superuser=True).first()
     # Load the template and context
     tmpl = loader.get_template(template_name=template)
     context = dict(sender=sender)
     context.update(extra_context)
 
-    body = tmpl.render(context)
-    html = mistune.markdown(body, escape=False)
+    text = tmpl.render(context)
+    html = mistune.markdown(text, escape=False)
 
-    msgs = []
-    for rec in rec_list:
-        body = MessageBody.objects.create(body=body, html=html)
-        msg = Message.objects.create(sender=sender, recipient=rec, body=body)
-        msgs.append(msg)
+    # The recipients share the message body.
+    body = MessageBody.objects.create(body=text, html=html)
+    msgs = [Message(sender=sender, recipient=rec, body=body, uid=util.get_uuid(10), sent_date=util.now())
+            for rec in rec_list]
+    Message.objects.bulk_create(msgs, batch_size=1000)
 
     return msgs
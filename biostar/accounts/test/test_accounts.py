@@ -229,3 +229,18 @@ class ProfileTest(TestCase):
         print(message, valid)
 
         self.assertTrue(not valid)
+
+    @override_settings(ADMINS=[])
+    def test_create_messages(self):
+        "Test messages are sent by a superuser without admins and share the message body"
+        from biostar.accounts import tasks
+
+        models.User.objects.create(username=f"admin{get_uuid(6)}", email="admin@l.com", is_superuser=True)
+        other = models.User.objects.create(username=f"tested{get_uuid(10)}", email="other@l.com")
+
+        msgs = tasks.create_messages(template="messages/welcome.md", rec_list=[self.user, other])
+
+        self.assertTrue(msgs[0].sender.is_superuser)
+        sent = models.Message.objects.filter(body=msgs[0].body)
+        self.assertEqual(set(sent.values_list("recipient", flat=True)), {self.user.pk, other.pk})
+        self.assertIsInstance(msgs[0].body.body, str)
@@ -189,7 +189,7 @@ def user_signup(request):
             Profile.objects.filter(user=user).update(last_login=now())
             messages.success(request, "Login successful!")
             msg = mark_safe("Signup successful!")
-            tasks.verification_email.spool(user=user)
+            tasks.verification_email.spool(user_id=user.id)
             messages.info(request, msg)
 
             return redirect("/")
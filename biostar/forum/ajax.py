@@ -19,7 +19,7 @@ from whoosh.searching import Results
 
 from biostar.accounts.models import Profile, User
 from . import auth, util, forms, tasks, search, views, const
-from .models import Post, Vote, Subscription
+from .models import Post, Vote, Subscription, SimilarPosts
 
 
 def ajax_msg(msg, status, **kwargs):
@@ -73,6 +73,16 @@ def ajax_test(request):
     return ajax_error(msg=msg)
 
 
+@ajax_error_wrapper(method="GET")
+def find_users(request):
+    """
+    Usernames starting with the prefix, used to autocomplete mentions.
+    """
+    prefix = request.GET.get('prefix', '')
+    users = auth.find_users(prefix=prefix)
+    return ajax_success(msg="Users found", users=users)
+
+
 @ajax_error_wrapper(method="GET")
 def user_image(request, username):
     user = User.objects.filter(username=username).first()
@@ -181,9 +191,13 @@ def drag_and_drop(request):
         parent = post.root
         post_type = Post.ANSWER
 
-    Post.objects.filter(uid=post.uid).update(type=post_type, parent=parent)
+    Post.objects.filter(uid=post.uid).update(type=post_type, parent=parent, indexed=False)
 
+    # Recount the previous and the new parent.
     post.update_parent_counts()
+    post.parent = parent
+    post.update_parent_counts()
+    auth.bump_thread(root_id=post.root_id)
     redir = post.get_absolute_url()
 
     return ajax_success(msg="success", redir=redir)
@@ -272,7 +286,9 @@ def release_suspect(request, uid):
     if post.author.profile.low_rep:
         post.author.profile.bump_over_threshold()
 
-    Post.objects.filter(uid=uid).update(spam=Post.NOT_SPAM)
+    Post.objects.filter(uid=uid).update(spam=Post.NOT_SPAM, indexed=False)
+    Post.objects.update_visibility(root_id=post.root_id)
+    auth.bump_thread(root_id=post.root_id, listings=True)
 
     return ajax_success(msg="Released from the quarantine.")
 
@@ -494,14 +510,12 @@ def inplace_form(request):
     # Load the content and form template
     template = "forms/form_inplace.html"
     tmpl = loader.get_template(template_name=template)
-    users_str = auth.get_users_str()
-
     nlines = post.num_lines(offset=3)
     rows = nlines if nlines >= MIN_LINES else MIN_LINES
     form = forms.PostLongForm(user=request.user)
 
     content = '' if add_comment else post.content
-    context = dict(user=user, post=post, new=add_comment,  html=html, users_str=users_str,
+    context = dict(user=user, post=post, new=add_comment,  html=html,
                    captcha_key=settings.RECAPTCHA_PUBLIC_KEY, rows=rows, form=form,
                    content=content)
 
@@ -515,19 +529,25 @@ def similar_posts(request, uid):
     Return a feed populated with posts similar to the one in the request.
     """
 
-    post = Post.objects.filter(uid=uid).first()
-    if not post:
-        ajax_error(msg='Post does not exist.')
+    similar = SimilarPosts.objects.filter(post__uid=uid).first()
+
+    if similar:
+        # Similar posts are computed when the post gets indexed.
+        results = json.loads(similar.data)
 
-    cache_key = f"{const.SIMILAR_CACHE_KEY}-{post.uid}"
-    results = cache.get(cache_key)
+        # Linked posts may have been closed, deleted or marked as spam since.
+        uids = [item['uid'] for item in results]
+        valid = Post.objects.valid_posts(uid__in=uids).exclude(spam=Post.SPAM)
+        valid = set(valid.values_list("uid", flat=True))
+        results = [item for item in results if item['uid'] in valid]
+    else:
+        post = Post.objects.filter(uid=uid).first()
+        if not post:
+            return ajax_error(msg='Post does not exist.')
 
-    if results is None:
-        logger.info("Setting similar posts cache.")
+        # Results are cached until the index changes.
         results = search.preform_search(query=post.uid, fields=['uid'], sortedby=["lastedit_date"],
                                         more_like_this=True)
-        # Set the results cache for 1 hour
-        cache.set(cache_key, results, 3600)
 
     template_name = 'widgets/similar_posts.html'
 
@@ -1,7 +1,13 @@
+import atexit
+import bisect
 import datetime
 import logging
 import json
 import hashlib
+import heapq
+import threading
+import time
+from collections import Counter, defaultdict
 import html2text
 import urllib.parse as urlparse
 from urllib import request
@@ -15,14 +21,22 @@ from django.utils.timezone import utc
 from django.core.cache import cache
 from django.shortcuts import reverse
 from biostar.accounts.models import Profile, Logger
-from . import util
+from . import util, tasks
 from .const import *
-from .models import Post, Vote, PostView, Subscription
+from .models import Post, Vote, PostView, Subscription, CacheVersion
 
 User = get_user_model()
 
 logger = logging.getLogger("engine")
 
+# Sorted usernames used for the mention autocomplete.
+USER_LOCK = threading.RLock()
+USER_INDEX = dict(keys=[], names={}, scores={}, top={}, built=0)
+
+# Post views counted since the last write to the database.
+VIEW_LOCK = threading.Lock()
+VIEW_BUFFER = dict(counts=Counter(), views=[], flushed=time.time())
+
 
 def get_votes(user, root):
     store = {
@@ -73,20 +87,90 @@ def decode_email(email):
     return
 
 
-def get_users_str():
+def build_user_index():
+    """
+    Sort the usernames for prefix lookups, ranked by the score of each user.
+    """
+    users = User.objects.values_list('id', 'username', 'profile__score')
+    names = {pk: name for pk, name, score in users}
+    scores = {name: score or 0 for pk, name, score in users}
+    keys = sorted((name.lower(), name) for name in names.values())
+
+    with USER_LOCK:
+        USER_INDEX.update(keys=keys, names=names, scores=scores, top={}, built=time.time())
+
+
+def refresh_user_index():
+    """
+    Rebuild the index of this process, picking up renames and score changes.
+    Processes that never answered an autocomplete are skipped.
+    """
+    if USER_INDEX['built']:
+        build_user_index()
+
+
+def index_user(pk, username):
+    """
+    Add a new or renamed user to a built index.
+    """
+    with USER_LOCK:
+        if not USER_INDEX['built']:
+            return
+
+        keys, names = USER_INDEX['keys'], USER_INDEX['names']
+        old = names.get(pk)
+        if old == username:
+            return
+
+        # Remove the previous username.
+        if old is not None:
+            pos = bisect.bisect_left(keys, (old.lower(), old))
+            if pos < len(keys) and keys[pos] == (old.lower(), old):
+                del keys[pos]
+
+        # Renamed users keep their score.
+        score = USER_INDEX['scores'].pop(old, 0)
+
+        bisect.insort(keys, (username.lower(), username))
+        names[pk] = username
+        USER_INDEX['scores'][username] = score
+        USER_INDEX['top'] = {}
+
+
+def find_users(prefix, limit=None):
     """
-    Return comma separated string of username used for autocomplete
+    Return the usernames starting with the prefix, highest score first.
     """
+    limit = limit or settings.USER_AUTOCOMPLETE_LIMIT
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
 
-    cache_days = 5
-    cache_secs = 60 * 60 * 24 * cache_days
+    # The first lookup of a process builds the index once,
+    # later rebuilds are run by the rebuild_user_index timer.
+    if not USER_INDEX['built']:
+        with USER_LOCK:
+            if not USER_INDEX['built']:
+                build_user_index()
 
-    users_str = cache.get(USERS_CACHE_KEY)
-    if users_str is None:
-        users_str = ','.join(User.objects.all().values_list('username', flat=True))
-        cache.set(USERS_CACHE_KEY, users_str, cache_secs)
+    with USER_LOCK:
+        # Short prefixes match many users, keep all of their results ranked.
+        if prefix in USER_INDEX['top']:
+            return USER_INDEX['top'][prefix][:limit]
 
-    return users_str
+        keys, scores = USER_INDEX['keys'], USER_INDEX['scores']
+        start = bisect.bisect_left(keys, (prefix,))
+        end = bisect.bisect_left(keys, (prefix + '\uffff',))
+
+        if len(prefix) <= 2:
+            ranked = sorted(keys[start:end], key=lambda key: scores.get(key[1], 0), reverse=True)
+            USER_INDEX['top'][prefix] = [name for low, name in ranked]
+            return USER_INDEX['top'][prefix][:limit]
+
+        found = heapq.nlargest(limit, keys[start:end], key=lambda key: scores.get(key[1], 0))
+        found = [name for low, name in found]
+
+    return found
 
 
 def gravatar(user, size=80):
@@ -114,23 +198,34 @@ def gravatar(user, size=80):
     return gravatar_url(email=email, style=style, size=size)
 
 
-def walk_down_thread(parent, collect=set()):
+def walk_down_thread(parent, collect=None):
     """
-    Recursively walk down a thread of posts starting from target
+    Walk down a thread of posts starting from target.
+    The thread is loaded with a single query and walked in memory.
     """
+    collect = set() if collect is None else collect
 
     # Stop condition: post does not have a root or parent.
-    if (parent is None) or (parent.parent is None) or (parent.root is None):
+    if (parent is None) or (parent.parent_id is None) or (parent.root_id is None):
         return collect
 
-    # Get all children for this post, excluding itself.
-    children = Post.objects.filter(parent=parent).exclude(uid=parent.uid)
-
-    for child in children:
+    # Map every post in the thread to its children, excluding itself.
+    posts = Post.objects.filter(root_id=parent.root_id).only("id", "uid", "parent_id", "root_id")
+    children = defaultdict(list)
+    for post in posts:
+        if post.parent_id != post.id:
+            children[post.parent_id].append(post)
+
+    # Walk the children with a stack, visiting each post once.
+    stack = list(children[parent.id])
+    while stack:
+        child = stack.pop()
+        if child in collect:
+            continue
         # Add child to list
         collect.add(child)
         # Get all children belonging to the current child.
-        walk_down_thread(parent=child, collect=collect)
+        stack.extend(children[child.id])
 
     return collect
 
@@ -283,6 +378,44 @@ def create_subscription(post, user, sub_type=None, update=False):
     Post.objects.filter(pk=post.root.pk).update(subs_count=subs_count)
 
 
+def create_subscriptions(post, users):
+    """
+    Subscribes many users to a post with their default subscription type.
+    Same as calling create_subscription with update=True for each user.
+    """
+    users = {user.id: user for user in users}
+    if not users:
+        return
+
+    root = post.root
+    subs = Subscription.objects.filter(post=root, user_id__in=users)
+    existing = set(subs.values_list("user_id", flat=True))
+
+    # Group the users by their default subscription type.
+    types = {}
+    for user in users.values():
+        sub_type = Subscription.TYPE_MAP.get(user.profile.message_prefs, Subscription.LOCAL_MESSAGE)
+        types.setdefault(sub_type, []).append(user.id)
+
+    # Reset existing subscriptions with one update per type.
+    for sub_type, ids in types.items():
+        ids = [uid for uid in ids if uid in existing]
+        if ids:
+            subs.filter(user_id__in=ids).update(type=sub_type)
+
+    # Insert the missing subscriptions in one query.
+    now = util.now()
+    created = [Subscription(post=root, user_id=uid, type=sub_type, date=now, uid=util.get_uuid(limit=16))
+               for sub_type, ids in types.items() for uid in ids if uid not in existing]
+    Subscription.objects.bulk_create(created)
+
+    # Recompute post subscription.
+    subs_count = Subscription.objects.filter(post=root).exclude(type=Profile.NO_MESSAGES).count()
+
+    # Update root subscription counts.
+    Post.objects.filter(pk=root.pk).update(subs_count=subs_count)
+
+
 def is_suspended(user):
     if user.is_authenticated and user.profile.state in (Profile.BANNED, Profile.SUSPENDED, Profile.SPAMMER):
         return True
@@ -290,6 +423,94 @@ def is_suspended(user):
     return False
 
 
+def cache_version(key):
+    """
+    Return the version stored under a key, kept in the database so that every process sees the same value.
+    """
+    version = CacheVersion.objects.filter(key=key).values_list("value", flat=True).first()
+    return version or 0
+
+
+def cache_versions(keys):
+    """
+    Return the versions stored under many keys with one query, keys never bumped are at version 0.
+    """
+    versions = dict(CacheVersion.objects.filter(key__in=keys).values_list("key", "value"))
+    return {key: versions.get(key, 0) for key in keys}
+
+
+def bump_versions(*keys):
+    """
+    Move the content stored under the keys to a new version, existing keys are moved with a single update.
+    """
+    keys = set(keys)
+    updated = CacheVersion.objects.filter(key__in=keys).update(value=F("value") + 1)
+    if updated == len(keys):
+        return
+
+    # Start from the clock so a reset database never reuses an old version.
+    start = int(time.time() * 1000)
+    found = set(CacheVersion.objects.filter(key__in=keys).values_list("key", flat=True))
+    for key in keys - found:
+        version, created = CacheVersion.objects.get_or_create(key=key, defaults=dict(value=start))
+
+        # Another process created the row first.
+        if not created:
+            CacheVersion.objects.filter(key=key).update(value=F("value") + 1)
+
+
+def bump_version(key):
+    """
+    Move the content stored under a key to a new version.
+    """
+    bump_versions(key)
+
+
+def thread_version(root_id):
+    """
+    Return the version of a thread, changes every time the thread is modified.
+    """
+    return cache_version(key=f"{THREAD_VERSION_KEY}-{root_id}")
+
+
+def bump_thread(root_id, listings=False):
+    """
+    Invalidate the rendered thread by moving it to a new version.
+    The post listings are moved in the same update when listings is True.
+    """
+    keys = [f"{THREAD_VERSION_KEY}-{root_id}"]
+    if listings:
+        keys.append(LISTING_VERSION_KEY)
+    bump_versions(*keys)
+
+
+def listing_version():
+    """
+    Return the version of the post listings, changes every time a post rank or visibility changes.
+    """
+    return cache_version(key=LISTING_VERSION_KEY)
+
+
+def bump_listings():
+    """
+    Invalidate the cached post listings by moving them to a new version.
+    """
+    bump_version(key=LISTING_VERSION_KEY)
+
+
+def thread_key(root, user):
+    """
+    Cache key of the rendered thread, only anonymous renders are cached.
+    Returns None for authenticated users. Each key costs a query for the thread version.
+    """
+    # Votes and edit permissions are decorated per user.
+    if user.is_authenticated:
+        return None
+
+    version = thread_version(root_id=root.id)
+    return f"{THREAD_CACHE_KEY}-{root.uid}-{version}"
+
+
 def post_tree(user, root):
     """
     Populates a tree that contains all posts in the thread.
@@ -357,17 +578,67 @@ def update_post_views(post, request, minutes=settings.POST_VIEW_MINUTES):
     ip2 = '' if ip2.lower() == 'localhost' else ip2
     ip = ip1 or ip2 or '0.0.0.0'
 
-    now = util.now()
-    since = now - datetime.timedelta(minutes=minutes)
-
     # One view per time interval from each IP address.
-    if not PostView.objects.filter(ip=ip, post=post, date__gt=since).exists():
-        # Update the last time
-        PostView.objects.create(ip=ip, post=post, date=now)
-        Post.objects.filter(pk=post.pk).update(view_count=F('view_count') + 1)
+    key = f"{POST_VIEW_KEY}-{ip}-{post.pk}"
+    if cache.add(key, 1, timeout=minutes * 60):
+        buffer_view(post=post, ip=ip)
+
     return post
 
 
+def buffer_view(post, ip):
+    """
+    Count a post view in memory, the buffer is written out when full or old enough.
+    """
+    with VIEW_LOCK:
+        VIEW_BUFFER['counts'][post.pk] += 1
+        VIEW_BUFFER['views'].append((post.pk, ip, util.now()))
+        size = len(VIEW_BUFFER['views'])
+        elapsed = time.time() - VIEW_BUFFER['flushed']
+
+    if size >= settings.POST_VIEW_BUFFER_SIZE or elapsed >= settings.POST_VIEW_FLUSH_SECS:
+        flush_views()
+
+
+def flush_views():
+    """
+    Write the buffered views to the database with one update per distinct increment.
+    """
+    with VIEW_LOCK:
+        counts, views = VIEW_BUFFER['counts'], VIEW_BUFFER['views']
+        VIEW_BUFFER.update(counts=Counter(), views=[], flushed=time.time())
+
+    if not views:
+        return 0
+
+    # Posts viewed the same number of times are updated together.
+    increments = defaultdict(list)
+    for pk, count in counts.items():
+        increments[count].append(pk)
+
+    for count, pks in increments.items():
+        Post.objects.filter(pk__in=pks).update(view_count=F('view_count') + count)
+
+    if settings.POST_VIEW_RECORD:
+        # Posts may have been deleted since they were viewed.
+        existing = set(Post.objects.filter(pk__in=counts).values_list('pk', flat=True))
+        objs = [PostView(post_id=pk, ip=ip, date=date) for pk, ip, date in views if pk in existing]
+        PostView.objects.bulk_create(objs, batch_size=500)
+
+    return len(views)
+
+
+@atexit.register
+def flush_on_exit():
+    """
+    Keep the views buffered by this process when it shuts down.
+    """
+    try:
+        flush_views()
+    except Exception as exc:
+        logger.error(f"Unable to save post views: {exc}")
+
+
 @transaction.atomic
 def apply_vote(post, user, vote_type):
     vote = Vote.objects.filter(author=user, post=post, type=vote_type).first()
@@ -381,36 +652,39 @@ def apply_vote(post, user, vote_type):
         vote = Vote.objects.create(author=user, post=post, type=vote_type)
         msg = "%s added" % vote.get_type_display()
 
-    if post.author == user:
+    if post.author_id == user.id:
         # Author making the change
         change = 0
         return msg, vote, change
 
-    # Fetch user score
-    score = len(Vote.objects.filter(post__author=post.author).exclude(author=post.author))
     # Update the user score.
-    Profile.objects.filter(user=post.author).update(score=score)
-
-    # Calculate counts for the current post
-    votes = list(Vote.objects.filter(post=post).exclude(author=post.author))
-    vote_count = len(votes)
-    bookcount = len(list(filter(lambda v: v.type == Vote.BOOKMARK, votes)))
-    accept_count = len(list(filter(lambda v: v.type == Vote.ACCEPT, votes)))
+    Profile.objects.filter(user_id=post.author_id).update(score=F('score') + change)
 
-    # Increment the post vote count.
-    Post.objects.filter(uid=post.uid).update(vote_count=vote_count)
-
-    # The thread vote count represents all votes in a thread
-    Post.objects.filter(uid=post.root.uid).update(thread_votecount=F('thread_votecount') + change)
+    # Counts for the current post.
+    counts = dict(vote_count=F('vote_count') + change)
 
     # Increment the bookmark count.
     if vote_type == Vote.BOOKMARK:
-        Post.objects.filter(uid=post.uid).update(book_count=bookcount)
+        counts.update(book_count=F('book_count') + change)
 
     # Handle accepted vote.
     if vote_type == Vote.ACCEPT:
-        Post.objects.filter(uid=post.uid).update(accept_count=accept_count)
-        Post.objects.filter(uid=post.root.uid).update(accept_count=F('accept_count') + change)
+        counts.update(accept_count=F('accept_count') + change)
+
+    # The thread vote count represents all votes in a thread
+    if post.root_id == post.id:
+        counts.update(thread_votecount=F('thread_votecount') + change)
+    else:
+        roots = dict(thread_votecount=F('thread_votecount') + change)
+        # The root accept count represents all accepted posts in the thread.
+        if vote_type == Vote.ACCEPT:
+            roots.update(accept_count=F('accept_count') + change)
+        Post.objects.filter(id=post.root_id).update(**roots)
+
+    Post.objects.filter(id=post.id).update(**counts)
+
+    # Rendered vote counts are out of date.
+    bump_thread(root_id=post.root_id)
 
     return msg, vote, change
 
@@ -457,11 +731,23 @@ class Moderate(object):
         if action in action_map:
             mod_func = action_map[action]
             mod_func()
+            Post.objects.update_visibility(root_id=post.root_id)
+            bump_thread(root_id=post.root_id, listings=True)
         else:
             logger.error("Unknown moderation action given.")
 
+    def reindex(self):
+        """
+        Queue the post for indexing. The replies of a top level post are
+        only searchable while it is open, so the whole thread is queued.
+        """
+        if self.post.is_toplevel:
+            Post.objects.filter(root_id=self.post.root_id).update(indexed=False)
+        else:
+            Post.objects.filter(uid=self.post.uid).update(indexed=False)
+
     def move(self):
-        Post.objects.filter(uid=self.post.uid).update(type=Post.ANSWER)
+        Post.objects.filter(uid=self.post.uid).update(type=Post.ANSWER, indexed=False)
         self.msg = f"Moved post={self.post.uid} to answer. "
 
     def open(self):
@@ -470,11 +756,13 @@ class Moderate(object):
             self.post.author.profile.bump_over_threshold()
 
         Post.objects.filter(uid=self.post.uid).update(status=Post.OPEN, spam=Post.NOT_SPAM)
+        self.reindex()
         self.msg = f"Opened post: {self.post.title}"
 
     def bump(self):
         self.msg = "Post bumped"
-        Post.objects.filter(uid=self.post.uid).update(lastedit_date=self.now, rank=self.now.timestamp())
+        Post.objects.filter(uid=self.post.uid).update(lastedit_date=self.now, rank=self.now.timestamp(),
+                                                   indexed=False)
 
     def spam(self):
         """
@@ -493,6 +781,7 @@ class Moderate(object):
         """
 
         Post.objects.filter(uid=self.post.uid).update(status=Post.CLOSED)
+        self.reindex()
         # Generate a rationale post on why this post is closed.
         context = dict(comment=self.comment)
         rationale = mod_rationale(post=self.post, user=self.user,
@@ -521,6 +810,7 @@ class Moderate(object):
         if self.__delete_only:
             # Deleted posts can be un=deleted by re-opening them.
             Post.objects.filter(uid=self.post.uid).update(status=Post.DELETED)
+            self.reindex()
             self.url = self.post.root.get_absolute_url()
             self.msg = f"Deleted post: {self.post.title}"
             self.post.recompute_scores()
@@ -531,12 +821,17 @@ class Moderate(object):
             self.url = "/"
         else:
             self.url = self.post.root.get_absolute_url()
-            self.post.root.recompute_scores()
 
         # Remove post from the database with no trace.
         self.msg = f"Removed post: {self.post.title}"
         self.post.delete()
 
+        # Recount the thread without the removed post.
+        self.post.recompute_scores()
+
+        # Removed posts can not be picked up by the indexing queue.
+        tasks.remove_from_index.spool(uid=self.post.uid)
+
     @property
     def __delete_only(self):
         # Posts with children or older than some value can only be deleted not removed
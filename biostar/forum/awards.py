@@ -1,10 +1,15 @@
+import hashlib
 import logging
 
+from django.db.models import Count
+from django.db.models.functions import Length
 from django.utils.timezone import utc
 from datetime import datetime, timedelta
 
-from biostar.accounts.models import User
-from biostar.forum.models import Post, Vote, Badge, Award
+from biostar.accounts.models import User, Profile
+from biostar.accounts.tasks import create_messages, default_sender
+from biostar.forum import const
+from biostar.forum.models import Post, Vote, Badge, Award, CacheVersion
 
 logger = logging.getLogger("engine")
 
@@ -13,16 +18,34 @@ def now():
     return datetime.utcnow().replace(tzinfo=utc)
 
 
-def wrap_qs(cond, klass, pk):
+def post_rule(**filters):
+    """
+    Rule for awards given for each post of the users matching the filters.
+    """
+    def rule(users):
+        query = Post.objects.filter(author__in=users, **filters)
+        return query.values_list("author_id", "id")
+    return rule
 
-    return klass.objects.filter(pk=pk) if cond else klass.objects.none()
+
+def count_rule(model, field, total, **filters):
+    """
+    Rule for awards given to users with more than total rows of the model.
+    The field links the rows to the user.
+    """
+    def rule(users):
+        query = model.objects.filter(**{f"{field}__in": users}, **filters)
+        query = query.values(field).annotate(count=Count("id")).filter(count__gt=total)
+        return [(user_id, None) for user_id in query.values_list(field, flat=True)]
+    return rule
 
 
 class AwardDef(object):
-    def __init__(self, name, desc, func, icon, max=None, type=Badge.BRONZE):
+    def __init__(self, name, desc, rule, icon, max=None, type=Badge.BRONZE):
         self.name = name
         self.desc = desc
-        self.fun = func
+        # Returns the (user id, post id) pairs that earn the award, one query for all users.
+        self.rule = rule
         self.icon = icon
         self.template = ""
         self.type = type
@@ -30,23 +53,17 @@ class AwardDef(object):
         # No limit if left empty.
         self.max = max
 
-    def validate(self, *args, **kwargs):
-
-        user = args[0]
+    def targets(self, users):
+        """
+        Returns the (user id, post id) pairs earned by the users, ordered by user and post.
+        """
         try:
-            value = self.fun(*args, **kwargs).order_by("pk")
+            pairs = list(self.rule(users))
         except Exception as exc:
-            logger.error("validator error %s" % exc)
-            return []
-
-        # Award user has won at this point.
-        awarded = Award.objects.filter(badge__name=self.name, user=user)
-
-        # Ensure users does not get over rewarded.
-        if self.max and len(awarded) >= self.max:
+            logger.error("award rule error %s" % exc)
             return []
 
-        return value
+        return sorted(pairs, key=lambda pair: (pair[0], pair[1] or 0))
 
     def __hash__(self):
         return hash(self.name)
@@ -55,11 +72,18 @@ class AwardDef(object):
         return self.name == other.name
 
 
+def autobiographer(users):
+    # Users with a long profile text.
+    query = Profile.objects.filter(user__in=users, score__gt=1)
+    query = query.annotate(size=Length("text")).filter(size__gt=110)
+    return [(user_id, None) for user_id in query.values_list("user_id", flat=True)]
+
+
 # Award definitions
 AUTOBIO = AwardDef(
     name="Autobiographer",
     desc="has more than 110 characters in the information field of the user's profile",
-    func=lambda user: wrap_qs(len(user.profile.text) > 110 and user.profile.score > 1, User, user.id),
+    rule=autobiographer,
     max=1,
     icon="bullhorn icon"
 )
@@ -67,7 +91,7 @@ AUTOBIO = AwardDef(
 GOOD_QUESTION = AwardDef(
     name="Good Question",
     desc="asked a question that was upvoted at least 5 times",
-    func=lambda user: Post.objects.filter(vote_count__gte=5, author=user, type=Post.QUESTION),
+    rule=post_rule(vote_count__gte=5, type=Post.QUESTION),
     max=1,
     icon="question icon"
 )
@@ -75,7 +99,7 @@ GOOD_QUESTION = AwardDef(
 GOOD_ANSWER = AwardDef(
     name="Good Answer",
     desc="created an answer that was upvoted at least 5 times",
-    func=lambda user: Post.objects.filter(vote_count__gt=5, author=user, type=Post.ANSWER),
+    rule=post_rule(vote_count__gt=5, type=Post.ANSWER),
     max=1,
     icon="edit outline icon"
 )
@@ -83,7 +107,7 @@ GOOD_ANSWER = AwardDef(
 STUDENT = AwardDef(
     name="Student",
     desc="asked a question with at least 3 up-votes",
-    func=lambda user: Post.objects.filter(vote_count__gt=2, author=user, type=Post.QUESTION),
+    rule=post_rule(vote_count__gt=2, type=Post.QUESTION),
     max=1,
     icon="certificate icon"
 )
@@ -91,7 +115,7 @@ STUDENT = AwardDef(
 TEACHER = AwardDef(
     name="Teacher",
     desc="created an answer with at least 3 up-votes",
-    func=lambda user: Post.objects.filter(vote_count__gt=2, author=user, type=Post.ANSWER),
+    rule=post_rule(vote_count__gt=2, type=Post.ANSWER),
     max=1,
     icon="smile outline icon"
 )
@@ -99,7 +123,7 @@ TEACHER = AwardDef(
 COMMENTATOR = AwardDef(
     name="Commentator",
     desc="created a comment with at least 3 up-votes",
-    func=lambda user: Post.objects.filter(vote_count__gt=2, author=user, type=Post.COMMENT),
+    rule=post_rule(vote_count__gt=2, type=Post.COMMENT),
     max=1,
     icon="comment icon"
 )
@@ -107,7 +131,7 @@ COMMENTATOR = AwardDef(
 CENTURION = AwardDef(
     name="Centurion",
     desc="created 100 posts",
-    func=lambda user: wrap_qs(Post.objects.filter(author=user).count() > 100, User, user.id),
+    rule=count_rule(Post, "author", 100),
     max=1,
     icon="bolt icon",
     type=Badge.SILVER,
@@ -116,7 +140,7 @@ CENTURION = AwardDef(
 EPIC_QUESTION = AwardDef(
     name="Epic Question",
     desc="created a question with more than 10,000 views",
-    func=lambda user: Post.objects.filter(author=user, view_count__gt=10000),
+    rule=post_rule(view_count__gt=10000),
     max=1,
     icon="bullseye icon",
     type=Badge.GOLD,
@@ -125,7 +149,7 @@ EPIC_QUESTION = AwardDef(
 POPULAR = AwardDef(
     name="Popular Question",
     desc="created a question with more than 1,000 views",
-    func=lambda user: Post.objects.filter(author=user, view_count__gt=1000),
+    rule=post_rule(view_count__gt=1000),
     max=1,
     icon="eye icon",
     type=Badge.GOLD,
@@ -134,7 +158,7 @@ POPULAR = AwardDef(
 ORACLE = AwardDef(
     name="Oracle",
     desc="created more than 1,000 posts (questions + answers + comments)",
-    func=lambda user: wrap_qs(Post.objects.filter(author=user).count() > 1000, User, user.id),
+    rule=count_rule(Post, "author", 1000),
     max=1,
     icon="sun icon",
     type=Badge.GOLD,
@@ -143,7 +167,7 @@ ORACLE = AwardDef(
 PUNDIT = AwardDef(
     name="Pundit",
     desc="created a comment with more than 10 votes",
-    func=lambda user: Post.objects.filter(author=user, type=Post.COMMENT, vote_count__gt=10),
+    rule=post_rule(type=Post.COMMENT, vote_count__gt=10),
     max=1,
     icon="comments icon",
     type=Badge.SILVER,
@@ -152,7 +176,7 @@ PUNDIT = AwardDef(
 GURU = AwardDef(
     name="Guru",
     desc="received more than 100 upvotes",
-    func=lambda user: wrap_qs(Vote.objects.filter(post__author=user).count() > 100, User, user.id),
+    rule=count_rule(Vote, "post__author", 100),
     max=1,
     icon="beer icon",
     type=Badge.SILVER,
@@ -161,7 +185,7 @@ GURU = AwardDef(
 CYLON = AwardDef(
     name="Cylon",
     desc="received 1,000 up votes",
-    func=lambda user: wrap_qs(Vote.objects.filter(post__author=user).count() > 1000, User, user.id),
+    rule=count_rule(Vote, "post__author", 1000),
     max=1,
     icon="rocket icon",
     type=Badge.GOLD,
@@ -170,7 +194,7 @@ CYLON = AwardDef(
 VOTER = AwardDef(
     name="Voter",
     desc="voted more than 100 times",
-    func=lambda user: wrap_qs(Vote.objects.filter(author=user).count() > 100, User, user.id),
+    rule=count_rule(Vote, "author", 100),
     max=1,
     icon="thumbs up outline icon"
 )
@@ -178,7 +202,7 @@ VOTER = AwardDef(
 SUPPORTER = AwardDef(
     name="Supporter",
     desc="voted at least 25 times",
-    func=lambda user: wrap_qs(Vote.objects.filter(author=user).count() > 25, User, user.id),
+    rule=count_rule(Vote, "author", 25),
     max=1,
     icon="thumbs up icon",
     type=Badge.SILVER,
@@ -187,7 +211,7 @@ SUPPORTER = AwardDef(
 SCHOLAR = AwardDef(
     name="Scholar",
     desc="created an answer that has been accepted",
-    func=lambda user: Post.objects.filter(author=user, type=Post.ANSWER, accept_count__gt=0),
+    rule=post_rule(type=Post.ANSWER, accept_count__gt=0),
     max=1,
     icon="check circle outline icon"
 )
@@ -195,7 +219,7 @@ SCHOLAR = AwardDef(
 PROPHET = AwardDef(
     name="Prophet",
     desc="created a post with more than 20 followers",
-    func=lambda user: Post.objects.filter(author=user, type__in=Post.TOP_LEVEL, subs_count__gt=20),
+    rule=post_rule(type__in=Post.TOP_LEVEL, subs_count__gt=20),
     max=1,
     icon="leaf icon"
 )
@@ -203,23 +227,23 @@ PROPHET = AwardDef(
 LIBRARIAN = AwardDef(
     name="Librarian",
     desc="created a post with more than 10 bookmarks",
-    func=lambda user: Post.objects.filter(author=user, type__in=Post.TOP_LEVEL, book_count__gt=10),
+    rule=post_rule(type__in=Post.TOP_LEVEL, book_count__gt=10),
     max=1,
     icon="bookmark outline icon"
 )
 
 
-def rising_star(user):
+def rising_star(users):
     # The user joined no more than three months ago
-    cond = now() < user.profile.date_joined + timedelta(weeks=15)
-    cond = cond and Post.objects.filter(author=user).count() > 50
-    return wrap_qs(cond, User, user.id)
+    joined = now() - timedelta(weeks=15)
+    rule = count_rule(Post, "author", 50, author__profile__date_joined__gt=joined)
+    return rule(users)
 
 
 RISING_STAR = AwardDef(
     name="Rising Star",
     desc="created 50 posts within first three months of joining",
-    func=rising_star,
+    rule=rising_star,
     icon="star icon",
     max=1,
     type=Badge.GOLD,
@@ -229,7 +253,7 @@ RISING_STAR = AwardDef(
 GREAT_QUESTION = AwardDef(
     name="Great Question",
     desc="created a question with more than 5,000 views",
-    func=lambda user: Post.objects.filter(author=user, view_count__gt=5000),
+    rule=post_rule(view_count__gt=5000),
     icon="fire icon",
     type=Badge.SILVER,
 )
@@ -237,7 +261,7 @@ GREAT_QUESTION = AwardDef(
 GOLD_STANDARD = AwardDef(
     name="Gold Standard",
     desc="created a post with more than 25 bookmarks",
-    func=lambda user: Post.objects.filter(author=user, book_count__gt=25),
+    rule=post_rule(book_count__gt=25),
     icon="bookmark icon",
     type=Badge.GOLD,
 )
@@ -245,7 +269,7 @@ GOLD_STANDARD = AwardDef(
 APPRECIATED = AwardDef(
     name="Appreciated",
     desc="created a post with more than 5 votes",
-    func=lambda user: Post.objects.filter(author=user, vote_count__gt=5),
+    rule=post_rule(vote_count__gt=5),
     icon="heart icon",
     type=Badge.SILVER,
 )
@@ -278,3 +302,134 @@ ALL_AWARDS = [
     GOLD_STANDARD,
     APPRECIATED,
 ]
+
+
+def award_uid(badge_id, user_id, post_id, seen, capped):
+    """
+    Returns the same uid for an award computed by concurrent runs, the unique uid drops the duplicates.
+    Capped awards are numbered per user, the others are given once per post.
+    """
+    target = seen if capped else post_id
+    text = f"{badge_id}-{user_id}-{capped}-{target}"
+    return hashlib.md5(text.encode("utf-8")).hexdigest()[:16]
+
+
+def create_awards(users):
+    """
+    Creates the awards earned by the users with one query per award.
+    The users are a queryset, returns the number of new awards.
+    """
+    badges = {badge.name: badge for badge in Badge.objects.filter(name__in=[award.name for award in ALL_AWARDS])}
+
+    # Awards the users already have.
+    existing = set(Award.objects.filter(user__in=users).values_list("badge_id", "user_id", "post_id"))
+
+    # Number of times each badge was given to each user.
+    counts = dict()
+    for badge_id, user_id, post_id in existing:
+        counts[(badge_id, user_id)] = counts.get((badge_id, user_id), 0) + 1
+
+    earned = []
+    for award in ALL_AWARDS:
+        badge = badges.get(award.name)
+        if not badge:
+            continue
+
+        for user_id, post_id in award.targets(users):
+            # Do not award a post multiple times.
+            if (badge.id, user_id, post_id) in existing:
+                continue
+
+            # Ensure users do not get over rewarded.
+            seen = counts.get((badge.id, user_id), 0)
+            if award.max and seen >= award.max:
+                continue
+
+            existing.add((badge.id, user_id, post_id))
+            counts[(badge.id, user_id)] = seen + 1
+            uid = award_uid(badge_id=badge.id, user_id=user_id, post_id=post_id, seen=seen, capped=bool(award.max))
+            earned.append((badge, user_id, post_id, uid))
+
+    if not earned:
+        return 0
+
+    # Awards are dated at the last visit of the user.
+    dates = dict(Profile.objects.filter(user_id__in={user_id for _, user_id, _, _ in earned}).values_list("user_id", "last_login"))
+
+    awards = [Award(badge=badge, user_id=user_id, post_id=post_id, date=dates.get(user_id) or now(), uid=uid)
+              for badge, user_id, post_id, uid in earned]
+
+    # Awards already created by a concurrent run are skipped.
+    Award.objects.bulk_create(awards, batch_size=1000, ignore_conflicts=True)
+
+    # Bulk inserts do not send the post_save signal that messages single awards.
+    send_award_messages(awards)
+
+    return len(awards)
+
+
+def send_award_messages(awards):
+    """
+    Sends a local message to the user of each award.
+    Awards of the same badge and post share the message body.
+    """
+    sender = default_sender()
+    if not sender:
+        logger.error("No admin user to send the award messages from.")
+        return
+
+    posts = Post.objects.select_related("root").in_bulk({award.post_id for award in awards if award.post_id})
+    users = User.objects.in_bulk({award.user_id for award in awards})
+
+    groups = dict()
+    for award in awards:
+        groups.setdefault((award.badge_id, award.post_id), []).append(award)
+
+    for group in groups.values():
+        award = group[0]
+        award.post = posts.get(award.post_id)
+        rec_list = [users[item.user_id] for item in group if item.user_id in users]
+        create_messages(template="messages/awards_created.md", rec_list=rec_list, sender=sender,
+                        extra_context=dict(award=award))
+
+
+def claim_run(start):
+    """
+    Claims the visits made until start, the time of the previous run is stored in the database.
+    Returns the time of the previous run, or None when a concurrent run claimed it first.
+    """
+    value = int(start.timestamp() * 1000)
+    runs = CacheVersion.objects.filter(key=const.AWARDS_RUN_KEY)
+    previous = runs.values_list("value", flat=True).first()
+
+    if previous is None:
+        # Fall back to a day of visits when the time of the previous run is not known.
+        run, created = CacheVersion.objects.get_or_create(key=const.AWARDS_RUN_KEY, defaults=dict(value=value))
+        return start - timedelta(days=1) if created else None
+
+    # Only one run moves the stored time forward.
+    if not runs.filter(value=previous).update(value=value):
+        return None
+
+    return datetime.fromtimestamp(previous / 1000, tz=utc)
+
+
+def create_recent_awards():
+    """
+    Creates the awards of users that visited the site since the previous run.
+    """
+    start = now()
+    since = claim_run(start)
+    if since is None:
+        return 0
+
+    users = User.objects.filter(profile__last_login__gte=since)
+    try:
+        total = create_awards(users)
+    except Exception:
+        # The next run covers the same visits again.
+        value = int(since.timestamp() * 1000)
+        CacheVersion.objects.filter(key=const.AWARDS_RUN_KEY, value=int(start.timestamp() * 1000)).update(value=value)
+        raise
+
+    return total
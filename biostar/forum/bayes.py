@@ -0,0 +1,269 @@
+import logging
+import os
+import random
+import shutil
+import time
+import zlib
+from functools import lru_cache, wraps
+from itertools import islice
+from django.conf import settings
+from whoosh.analysis import StemmingAnalyzer
+from whoosh.writing import BufferedWriter
+from biostar.forum.models import Post
+from biostar.forum import search, spam
+
+try:
+    import numpy as np
+
+    NUMPY_INSTALLED = True
+except ImportError as exc:
+    NUMPY_INSTALLED = False
+
+logger = logging.getLogger("engine")
+
+# Same token stream as the spam index.
+ANALYZER = StemmingAnalyzer()
+
+# Models loaded from disk keyed by file name.
+MODELS = {}
+
+
+def numpy_required(func):
+    """
+    Ensure numpy is installed before calling function
+    """
+
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        if NUMPY_INSTALLED:
+            return func(*args, **kwargs)
+        logger.error(f"numpy not installed.")
+        return
+
+    return wrap
+
+
+@lru_cache(maxsize=100000)
+def feature(word, nfeatures):
+    """
+    Hash a word into one of the feature columns.
+    """
+    return zlib.crc32(word.encode("utf-8")) % nfeatures
+
+
+def tokenize(text):
+    return [token.text for token in ANALYZER(text or "")]
+
+
+def post_text(title, content):
+    return f"{title or ''} {content or ''}"
+
+
+def hash_features(texts, nfeatures):
+    """
+    Returns the row and column of every hashed token in the texts.
+    """
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        tokens = [feature(word, nfeatures) for word in tokenize(text)]
+        rows.extend([row] * len(tokens))
+        cols.extend(tokens)
+
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+
+def training_data(limit=500):
+    """
+    Returns texts and labels from the same posts that build_spam_index selects.
+    """
+    spam_ids, ham_ids = spam.training_ids(limit=limit, add_ham=True)
+    spam_ids = set(spam_ids)
+
+    posts = Post.objects.filter(id__in=spam_ids.union(ham_ids)).values_list("id", "title", "content")
+    posts = list(posts)
+    random.shuffle(posts)
+
+    texts = [post_text(title, content) for pk, title, content in posts]
+    labels = [pk in spam_ids for pk, title, content in posts]
+
+    return texts, labels
+
+
+@numpy_required
+def train(texts, labels, nfeatures=None, alpha=1.0):
+    """
+    Fit a multinomial Naive Bayes model on hashed bag of words.
+    """
+    nfeatures = nfeatures or settings.SPAM_MODEL_FEATURES
+    labels = np.array(labels, dtype=bool)
+    rows, cols = hash_features(texts, nfeatures=nfeatures)
+
+    # Word counts per class.
+    is_spam = labels[rows]
+    spam_counts = np.bincount(cols[is_spam], minlength=nfeatures) + alpha
+    ham_counts = np.bincount(cols[~is_spam], minlength=nfeatures) + alpha
+
+    # Log probability ratio of each feature.
+    weights = np.log(spam_counts / spam_counts.sum()) - np.log(ham_counts / ham_counts.sum())
+
+    # Log prior odds, smoothed for one sided training sets.
+    nspam = labels.sum()
+    bias = np.log((nspam + 1) / (len(labels) - nspam + 1))
+
+    return dict(weights=weights, bias=np.float64(bias))
+
+
+@numpy_required
+def predict(model, texts):
+    """
+    Returns the spam probability of each text.
+    """
+    weights = model['weights']
+    rows, cols = hash_features(texts, nfeatures=len(weights))
+    odds = np.bincount(rows, weights=weights[cols], minlength=len(texts)) + model['bias']
+
+    # Clip to keep exp() in range for very long posts.
+    return 1 / (1 + np.exp(-np.clip(odds, -500, 500)))
+
+
+@numpy_required
+def save_model(model, fname=None):
+    fname = fname or settings.SPAM_MODEL_FILE
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'wb') as stream:
+        np.savez(stream, **model)
+    MODELS.pop(fname, None)
+    logger.info(f"Saved spam model to {fname}")
+
+
+@numpy_required
+def load_model(fname=None):
+    """
+    Returns the spam model stored in the file, reloaded when the file changes.
+    """
+    fname = fname or settings.SPAM_MODEL_FILE
+    if not os.path.isfile(fname):
+        return None
+
+    mtime = os.path.getmtime(fname)
+    loaded, model = MODELS.get(fname, (None, None))
+    if loaded != mtime:
+        with np.load(fname) as data:
+            model = dict(weights=data['weights'], bias=data['bias'])
+        MODELS[fname] = (mtime, model)
+
+    return model
+
+
+def score_posts(posts, model=None, batch=1000):
+    """
+    Yields each post with its spam probability, scoring one batch at a time.
+    """
+    # Generators can not be wrapped with numpy_required.
+    if not NUMPY_INSTALLED:
+        logger.error(f"numpy not installed.")
+        return
+
+    model = model or load_model()
+    if model is None:
+        logger.error("Spam model not found, train it first.")
+        return
+
+    stream = iter(posts)
+    while True:
+        chunk = list(islice(stream, batch))
+        if not chunk:
+            break
+        texts = [post_text(post.title, post.content) for post in chunk]
+        yield from zip(chunk, predict(model, texts))
+
+
+def classify(posts, model=None, batch=1000, threshold=None):
+    """
+    Stores the spam probability of each post as its spam score.
+    Returns the posts predicted to be spam.
+    """
+    threshold = settings.SPAM_MODEL_THRESHOLD if threshold is None else threshold
+
+    suspects, scored = [], []
+    for post, prob in score_posts(posts=posts, model=model, batch=batch):
+        post.spam_score = float(prob)
+        scored.append(post)
+        if prob >= threshold:
+            suspects.append(post)
+
+    Post.objects.bulk_update(scored, ["spam_score"], batch_size=batch)
+
+    return suspects
+
+
+def count(labels, predicted):
+    """
+    Returns the tn, tp, fn, fp counts of a prediction.
+    """
+    tn = tp = fn = fp = 0
+    for is_spam, predicted_spam in zip(labels, predicted):
+        tp += is_spam and predicted_spam
+        fp += (not is_spam) and predicted_spam
+        fn += is_spam and (not predicted_spam)
+        tn += (not is_spam) and (not predicted_spam)
+    return tn, tp, fn, fp
+
+
+@numpy_required
+def evaluate(size=500, split=0.8, threshold=None, limitmb=1024):
+    """
+    Train on part of the posts and report both scorers on the rest.
+    """
+    threshold = settings.SPAM_MODEL_THRESHOLD if threshold is None else threshold
+
+    spam_ids, ham_ids = spam.training_ids(limit=size, add_ham=True)
+    labels = dict.fromkeys(ham_ids, False)
+    labels.update(dict.fromkeys(spam_ids, True))
+
+    posts = list(Post.objects.filter(id__in=labels).select_related("author__profile"))
+    random.shuffle(posts)
+    end = int(len(posts) * split)
+    trained, tested = posts[:end], posts[end:]
+    if not trained or not tested:
+        logger.error("Not enough posts to evaluate the spam model.")
+        return
+
+    actual = [labels[post.id] for post in tested]
+    nspam = sum(actual)
+    nham = len(actual) - nspam
+
+    # Naive Bayes model.
+    model = train(texts=[post_text(post.title, post.content) for post in trained],
+                  labels=[labels[post.id] for post in trained])
+    start = time.time()
+    predicted = [prob >= threshold for post, prob in score_posts(tested, model=model)]
+    rate = len(tested) / max(time.time() - start, 1e-6)
+
+    print(f"... {len(trained)}\tTrain size\n... {len(tested)}\tTest size\n")
+    print(f"... Naive Bayes model: {rate:0.1f} posts/sec")
+    tn, tp, fn, fp = count(labels=actual, predicted=predicted)
+    spam.report(nham=nham, nspam=nspam, tn=tn, tp=tp, fn=fn, fp=fp)
+
+    # Whoosh more like this scorer on an index of the same training posts.
+    if os.path.exists(spam.TRAIN_DIR):
+        shutil.rmtree(spam.TRAIN_DIR)
+    ix = search.init_index(dirname=spam.TRAIN_DIR, indexname=f"train_{settings.SPAM_INDEX_NAME}",
+                           schema=spam.spam_schema())
+    writer = BufferedWriter(ix, limit=len(trained) + 1, writerargs=dict(limitmb=limitmb, multisegment=True))
+    for post in trained:
+        spam.index_writer(writer=writer, title=post.title, content_length=len(post.content),
+                          content=post.content, uid=post.uid, is_spam=labels[post.id])
+    writer.commit()
+    writer.close()
+
+    start = time.time()
+    predicted = [spam.compute_score(post=post, ix=ix) >= settings.SPAM_THRESHOLD for post in tested]
+    rate = len(tested) / max(time.time() - start, 1e-6)
+    shutil.rmtree(spam.TRAIN_DIR)
+
+    print(f"\n... Whoosh scorer: {rate:0.1f} posts/sec")
+    tn, tp, fn, fp = count(labels=actual, predicted=predicted)
+    spam.report(nham=nham, nspam=nspam, tn=tn, tp=tp, fn=fn, fp=fp)
+
+    return model
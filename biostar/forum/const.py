@@ -12,7 +12,20 @@ BOOKMARKS_CACHE_KEY = "BOOKMARKS"
 MYTAGS_CACHE_KEY = "MYTAGS"
 
 SIMILAR_CACHE_KEY = "SIMILAR"
-USERS_CACHE_KEY = "MENTIONED_USERS"
+
+SEARCH_CACHE_KEY = "SEARCH"
+SEARCH_STATS_KEY = "SEARCH_STATS"
+
+POST_VIEW_KEY = "POST_VIEW"
+
+MARKDOWN_CACHE_KEY = "MARKDOWN"
+MARKDOWN_REF_KEY = "MARKDOWN_REF"
+
+THREAD_CACHE_KEY = "THREAD"
+THREAD_VERSION_KEY = "THREAD_VERSION"
+LISTING_CACHE_KEY = "LISTING"
+LISTING_VERSION_KEY = "LISTING_VERSION"
+AWARDS_RUN_KEY = "AWARDS_RUN"
 
 
 # The name of the session count data.
@@ -0,0 +1,26 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from biostar.accounts.models import User
+from biostar.forum import awards
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Create the awards earned by users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False, help="Evaluate every user.")
+        parser.add_argument('--uid', type=str, default="", help="Evaluate a single user by the profile uid.")
+
+    def handle(self, *args, **options):
+        if options['uid']:
+            total = awards.create_awards(User.objects.filter(profile__uid=options['uid']))
+        elif options['all']:
+            total = awards.create_awards(User.objects.all())
+        else:
+            # Users that visited the site since the previous run.
+            total = awards.create_recent_awards()
+
+        logger.info(f"Created {total} awards")
@@ -1,5 +1,8 @@
 
 import logging
+import shutil
+import tempfile
+import time
 from typing import Any
 
 from django.core.management.base import BaseCommand
@@ -10,6 +13,25 @@ from biostar.forum import search, spam
 logger = logging.getLogger('engine')
 
 
+def benchmark_rebuild():
+    """
+    Rebuilds the index of all valid posts into a temporary directory.
+    """
+    dirname = tempfile.mkdtemp(prefix="index-bench-")
+    try:
+        ix = search.init_index(dirname=dirname)
+        posts = Post.objects.valid_posts().exclude(spam=Post.SPAM)
+
+        start = time.time()
+        total = search.index_rows(posts=posts, ix=ix)
+        elapsed = time.time() - start
+
+        rate = total / elapsed if elapsed else 0
+        logger.info(f"Indexed {total} posts in {elapsed:.1f} seconds, {rate:.1f} docs/sec")
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+
 class Command(BaseCommand):
     help = 'Create search index for the forum app.'
 
@@ -19,6 +41,10 @@ class Command(BaseCommand):
         parser.add_argument('--remove', action='store_true', default=False, help="Removes the existing index.")
         parser.add_argument('--report', action='store_true', default=False, help="Reports on the content of the index.")
         parser.add_argument('--index', type=int, default=0, help="How many posts to index")
+        parser.add_argument('--workers', type=int, default=0,
+                            help="Rebuild the full index with this many processes.")
+        parser.add_argument('--benchmark', action='store_true', default=False,
+                            help="Reports docs/sec for a full rebuild into a temporary index.")
 
     def handle(self, *args, **options):
 
@@ -28,37 +54,38 @@ class Command(BaseCommand):
         remove = options['remove']
         report = options['report']
         index = options['index']
+        benchmark = options['benchmark']
+        workers = options['workers']
 
         # Sets the un-indexed flags to false on all posts.
         if reset:
             logger.info(f"Setting indexed field to false on all post.")
-            Post.objects.valid_posts(indexed=True).exclude(root=None).update(indexed=False)
+            Post.objects.filter(indexed=True).exclude(root=None).update(indexed=False)
+
+        # Rebuild the full index in parallel.
+        if workers:
+            logger.info(f"Rebuilding the index with {workers} workers")
+            total = search.rebuild_index(workers=workers)
+            logger.info(f"Indexed {total} posts")
 
         # Index a limited number yet unindexed posts
-        if index:
+        elif index:
 
-            # How many total posts can be indexed
-            start_count = Post.objects.valid_posts(indexed=False).exclude(root=None).count()
+            # How many total posts are queued for indexing.
+            start_count = Post.objects.filter(indexed=False).exclude(root=None).count()
             logger.info(f"Starting with {start_count} unindexed posts")
 
-            posts = Post.objects.valid_posts(indexed=False).exclude(root=None)[:index]
-            target_count = len(posts)
-
-            logger.info(f"Indexing {target_count} posts")
-
-            # The list of posts to update
-            ids = [ post.id for post in posts ]
-
-            # Add post to search index.
-            search.index_posts(posts=posts, overwrite=remove)
-
-            # Set the indexed field to true.
-            Post.objects.filter(id__in=ids).update(indexed=True)
+            # Drain a limited number of posts from the indexing queue.
+            target_count = search.update_index(limit=index, overwrite=remove)
+            logger.info(f"Indexed {target_count} posts")
 
-            count = Post.objects.valid_posts(indexed=False).exclude(root=None).count()
+            count = Post.objects.filter(indexed=False).exclude(root=None).count()
             logger.info(f"Finished with {count} unindexed posts remaining")
 
         # Report the contents of the index
         if report:
             search.print_info()
 
+        # Time a full rebuild without touching the live index.
+        if benchmark:
+            benchmark_rebuild()
@@ -0,0 +1,96 @@
+import logging
+from django.db.models import Count, F, Q, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+from biostar.accounts.models import Profile
+from biostar.forum.models import Post, Vote
+
+logger = logging.getLogger('engine')
+
+
+def count_votes(key, **kwargs):
+    """
+    Returns a subquery counting the votes not cast by the post author, grouped by key.
+    """
+    votes = Vote.objects.filter(**kwargs).exclude(author=F('post__author'))
+    votes = votes.order_by().values(key).annotate(total=Count('id')).values('total')
+    return Coalesce(Subquery(votes, output_field=IntegerField()), 0)
+
+
+def count_posts(key, hidden=None, **kwargs):
+    """
+    Returns a subquery counting the posts below a post, grouped by key.
+    """
+    posts = Post.objects.filter(**kwargs).exclude(pk=F(key))
+    posts = posts.exclude(hidden) if hidden else posts
+    posts = posts.order_by().values(key).annotate(total=Count('id')).values('total')
+    return Coalesce(Subquery(posts, output_field=IntegerField()), 0)
+
+
+def recount_replies():
+    """
+    Repair the reply counters maintained by update_parent_counts, one bulk update per level.
+    """
+
+    # Top level posts count the visible replies in the thread.
+    hidden = Q(status=Post.DELETED) | Q(spam=Post.SPAM)
+    total = Post.objects.filter(pk=F('root')).update(
+        reply_count=count_posts(key='root', hidden=hidden, root=OuterRef('pk')),
+        answer_count=count_posts(key='root', hidden=hidden, root=OuterRef('pk'), type=Post.ANSWER),
+        comment_count=count_posts(key='root', hidden=hidden, root=OuterRef('pk'), type=Post.COMMENT))
+    logger.info(f"Recounted replies for {total} threads")
+
+    # Other posts count their direct children.
+    total = Post.objects.filter(is_toplevel=False).update(
+        reply_count=count_posts(key='parent', parent=OuterRef('pk')),
+        comment_count=count_posts(key='parent', parent=OuterRef('pk'), type=Post.COMMENT),
+        answer_count=0)
+    logger.info(f"Recounted replies for {total} posts")
+
+    return
+
+
+def recount_scores():
+    """
+    Set every user score to the number of votes received from other users.
+
+    Scores also grow outside of votes, when moderators open a suspected post
+    of a new user or when scores are transferred from an older site.
+    Those increments are lost, only run this to rebuild scores from scratch.
+    """
+    total = Profile.objects.update(score=count_votes(key='post__author', post__author=OuterRef('user')))
+    logger.info(f"Recounted scores for {total} users")
+
+
+def recount_votes():
+    """
+    Repair the vote counters maintained by apply_vote, one bulk update per counter.
+    """
+
+    # Votes, bookmarks and accepts on each post.
+    Post.objects.update(vote_count=count_votes(key='post', post=OuterRef('pk')),
+                        book_count=count_votes(key='post', post=OuterRef('pk'), type=Vote.BOOKMARK),
+                        accept_count=count_votes(key='post', post=OuterRef('pk'), type=Vote.ACCEPT))
+
+    # Top level posts count the votes and accepts across the thread.
+    total = Post.objects.filter(pk=F('root')).update(
+        thread_votecount=count_votes(key='post__root', post__root=OuterRef('pk')),
+        accept_count=count_votes(key='post__root', post__root=OuterRef('pk'), type=Vote.ACCEPT))
+    logger.info(f"Recounted votes for {total} threads")
+
+    return
+
+
+class Command(BaseCommand):
+    help = 'Recompute the vote and reply counts of posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scores', action='store_true', default=False,
+                            help="Also reset user scores to the votes received, drops score increments not made by votes.")
+
+    def handle(self, *args, **options):
+        recount_votes()
+        recount_replies()
+
+        if options['scores']:
+            recount_scores()
@@ -0,0 +1,70 @@
+import logging
+import random
+import time
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from biostar.accounts.models import User
+from biostar.forum.models import Post
+from biostar.forum.templatetags import forum_tags
+from biostar.forum import util
+
+logger = logging.getLogger('engine')
+
+
+def build_thread(user, size, chain=False):
+    """
+    Build an unsaved thread with comments below the root.
+    Comments reply to a random earlier post or, as a chain, to the previous one.
+    """
+    now = util.now()
+    root = Post(id=1, uid="p1", title="Benchmark", type=Post.QUESTION, author=user, lastedit_user=user,
+                creation_date=now, lastedit_date=now, html="<p>Benchmark</p>")
+    root.root = root
+
+    nodes = [root]
+    tree = dict()
+    for index in range(2, size + 2):
+        parent = nodes[-1] if chain else random.choice(nodes)
+        post = Post(id=index, uid=f"p{index}", title="Comment", type=Post.COMMENT, author=user,
+                    lastedit_user=user, root=root, parent=parent, creation_date=now, lastedit_date=now,
+                    html=f"<p>Comment {index}</p>")
+        tree.setdefault(parent.id, []).append(post)
+        nodes.append(post)
+
+    return root, tree
+
+
+def benchmark(sizes):
+    """
+    Print the time to render the comment tree of threads with the given sizes.
+    """
+    user = User.objects.order_by("pk").first()
+    if not user:
+        logger.error("At least one user is needed to render comments.")
+        return
+
+    request = RequestFactory().get("/")
+    request.user = AnonymousUser()
+
+    for size in sizes:
+        for chain in (False, True):
+            root, tree = build_thread(user=user, size=size, chain=chain)
+            start = time.time()
+            html = forum_tags.traverse_comments(request=request, post=root, tree=tree,
+                                                template_name='widgets/comment_body.html')
+            elapsed = time.time() - start
+            shape = "chain" if chain else "random"
+            print(f"... {size}\tcomments\t{shape}\t{elapsed:0.3f} secs\t{len(html) // 1024} KB")
+
+
+class Command(BaseCommand):
+    help = 'Benchmark rendering the comment tree of a thread.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=str, default="10,1000,10000",
+                            help="Comma separated number of comments per thread.")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(",") if size.strip()]
+        benchmark(sizes=sizes)
@@ -7,7 +7,7 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from biostar.forum.models import Post
-from biostar.forum.search import preform_search
+from biostar.forum.search import preform_search, cache_stats
 
 logger = logging.getLogger('engine')
 
@@ -59,6 +59,19 @@ def print_results(results, limit=10, verbosity=0, finish_time=0.0, query=''):
     return
 
 
+def print_stats(limit=10):
+
+    stats = cache_stats()
+    print('-' * 20)
+    print(f'Hits\tMisses\tSearch')
+    for text, hits, misses in stats[:limit]:
+        print(f'{hits}\t{misses}\t{text}')
+    print('-' * 20)
+    print(f'Counted searches\t{len(stats)}')
+
+    return
+
+
 class Command(BaseCommand):
     help = 'Preform a search and generate report on results.'
 
@@ -71,6 +84,8 @@ class Command(BaseCommand):
         parser.add_argument('-l', '--limit', type=int, default=10,
                             help="Print limited amount of results.")
         parser.add_argument('-vr', '--verbose', type=int, default=1, help="Verbosity level of the report.")
+        parser.add_argument('--stats', action='store_true', default=False,
+                            help="Print hit and miss counts for cached searches.")
 
     def handle(self, *args, **options):
         logger.info(f"Database: {settings.DATABASE_NAME}. Index : {settings.INDEX_DIR}")
@@ -79,6 +94,12 @@ class Command(BaseCommand):
         query = options['query']
         limit = options['limit']
         verbosity = options['verbose']
+        stats = options['stats']
+
+        # Report on the search result cache.
+        if stats:
+            print_stats(limit=limit)
+            return
 
         # Preform a more like this search for a given uid
         if uid:
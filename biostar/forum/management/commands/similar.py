@@ -0,0 +1,25 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from biostar.forum import search
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Recompute the similar posts for all top level posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Number of processes to use.")
+        parser.add_argument('--size', type=int, default=1000, help="Number of posts handled by each task.")
+
+    def handle(self, *args, **options):
+        logger.info(f"Database: {settings.DATABASE_NAME}. Index : {settings.INDEX_DIR}")
+
+        workers = options['workers']
+        size = options['size']
+
+        total = search.rebuild_similar(workers=workers, size=size)
+
+        logger.info(f"Updated similar posts for {total} posts")
@@ -4,7 +4,7 @@ from django.db.models import Q
 from django.core.management.base import BaseCommand
 from biostar.forum.models import Post
 from django.conf import settings
-from biostar.forum import search, spam
+from biostar.forum import search, spam, bayes
 
 logger = logging.getLogger('engine')
 
@@ -23,6 +23,13 @@ class Command(BaseCommand):
         parser.add_argument('--limitmb', type=int, default=1024, help="Limit the size of the index buffer when testing")
         parser.add_argument('--index', action='store_true', default=False, help="How many posts to index")
         parser.add_argument('--verb', type=int, default=0, help="Set the verbosity")
+        parser.add_argument('--train', action='store_true', default=False,
+                            help="Train the Naive Bayes spam model on nsize spam and ham posts.")
+        parser.add_argument('--evaluate', action='store_true', default=False,
+                            help="Compare the Naive Bayes model with the index scorer on nsize posts.")
+        parser.add_argument('--classify', type=int, default=0,
+                            help="Store the Naive Bayes spam score of the latest posts.")
+        parser.add_argument('--batch', type=int, default=1000, help="Posts scored per batch.")
 
     def handle(self, *args, **options):
 
@@ -36,6 +43,10 @@ class Command(BaseCommand):
         niter = options['niter']
         nsize = options['nsize']
         limitmb = options['limitmb']
+        train = options['train']
+        evaluate = options['evaluate']
+        classify = options['classify']
+        batch = options['batch']
 
         # Sets the un-indexed flags to false on all posts.
         if reset:
@@ -49,3 +60,22 @@ class Command(BaseCommand):
         # Run specificity and sensitivity tests on posts.
         if test:
             spam.test_classify(niter=niter, size=nsize, limitmb=limitmb, verbosity=verbosity)
+
+        # Train and store the Naive Bayes spam model.
+        if train:
+            texts, labels = bayes.training_data(limit=nsize)
+            model = bayes.train(texts=texts, labels=labels)
+            if model is not None:
+                bayes.save_model(model)
+
+        # Report accuracy and throughput of both scorers.
+        if evaluate:
+            bayes.evaluate(size=nsize, limitmb=limitmb)
+
+        # Store the spam scores and print the posts predicted to be spam.
+        if classify:
+            posts = Post.objects.order_by("-id").only("uid", "title", "content", "spam_score")[:classify]
+            suspects = bayes.classify(posts=posts, batch=batch)
+            for post in suspects:
+                print(f"{post.uid}\t{post.spam_score:0.3f}\t{post.title}")
+            print(f"... {len(suspects)} out of {len(posts)} posts predicted as spam.")
@@ -0,0 +1,23 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from biostar.forum.models import Post
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Recompute which posts are visible to regular users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uid', type=str, default="", help="Recompute a single thread by the root uid.")
+
+    def handle(self, *args, **options):
+        uid = options['uid']
+
+        if uid:
+            total = Post.objects.update_visibility(root__uid=uid)
+        else:
+            total = Post.objects.update_visibility()
+
+        logger.info(f"Changed the visibility of {total} posts")
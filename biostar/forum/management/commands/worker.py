@@ -0,0 +1,80 @@
+import logging
+import os
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from biostar.forum import queue
+from biostar.utils import decorators
+
+# Importing the tasks declares the timers.
+from biostar.forum import tasks
+
+logger = logging.getLogger('engine')
+
+
+def shared_timers():
+    """
+    Returns the declared timers, the worker command is the only place they run when uwsgi is not installed.
+    Timers that target the web workers keep per process state and run with uwsgi only.
+    """
+    return [timer for timer in decorators.TIMERS if timer[2] != "workers"]
+
+
+def consume(name, stop):
+    """
+    Runs queued tasks until stopped, waits between polls when the queue is empty.
+    """
+    try:
+        while not stop.is_set():
+            # Drop connections that went stale while waiting.
+            close_old_connections()
+
+            # Each timer run is a task claimed by one worker across all hosts.
+            queue.schedule(shared_timers())
+
+            if not queue.drain(name):
+                stop.wait(settings.TASK_POLL_SECS)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Run the tasks stored in the database queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.TASK_WORKERS, help="Number of concurrent consumers.")
+        parser.add_argument('--once', action='store_true', default=False, help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        once = options['once']
+
+        # Identifies the host and process holding a task lease.
+        prefix = f"{socket.gethostname()}-{os.getpid()}"
+
+        if once:
+            total = queue.drain(prefix)
+            logger.info(f"Ran {total} tasks")
+            return
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=consume, args=(f"{prefix}-{i}", stop), daemon=True) for i in range(workers)]
+
+        for thread in threads:
+            thread.start()
+
+        logger.info(f"Started {workers} workers")
+
+        try:
+            for thread in threads:
+                # Join in short steps so that Ctrl-C is noticed.
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            logger.info("Stopping workers after the running tasks")
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -1,7 +1,13 @@
 """
 Markdown parser to render the Biostar style markdown.
 """
+import hashlib
+import json
+import logging
+import multiprocessing
 import re
+import threading
+from datetime import timedelta
 
 import mistune
 import requests
@@ -10,13 +16,18 @@ from django.shortcuts import reverse
 from django.db.models import F
 import bleach
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.module_loading import import_string
 from mistune import Renderer, InlineLexer, InlineGrammar
 from mistune import escape as escape_text
 
-from biostar.forum import auth
-from biostar.forum.models import Post, Subscription
+from biostar.forum import auth, const, util
+from biostar.forum.models import Post, Subscription, Embed
 from biostar.accounts.models import Profile, User
 
+logger = logging.getLogger("engine")
+
 # Test input.
 TEST_INPUT = '''
 
@@ -53,6 +64,12 @@ http://test.biostars.org/p/p371285/
 # Shortcut to re.compile
 rec = re.compile
 
+# Part of the html cache key, increment when the rendering rules change.
+RENDER_VERSION = 1
+
+# Parsers are reused within each thread.
+PARSERS = threading.local()
+
 # Biostar patterns
 PORT = ':' + settings.HTTP_PORT if settings.HTTP_PORT else ''
 SITE_URL = f"{settings.SITE_DOMAIN}{PORT}"
@@ -60,6 +77,10 @@ USER_PATTERN = rec(fr"^http(s)?://{SITE_URL}/accounts/profile/(?P<uid>[\w_.-]+)(
 POST_TOPLEVEL = rec(fr"^http(s)?://{SITE_URL}/p/(?P<uid>(\w+))(/)?$")
 POST_ANCHOR = rec(fr"^http(s)?://{SITE_URL}/p/\w+/\#(?P<uid>(\w+))(/)?")
 
+# Unanchored patterns used to collect the uids linked anywhere in the text.
+POST_UIDS = rec(fr"http(s)?://{SITE_URL}/p/(?P<uid>\w+)(/)?(\#(?P<anchor>\w+))?")
+USER_UIDS = rec(fr"http(s)?://{SITE_URL}/accounts/profile/(?P<uid>[\w_.-]+)")
+
 # Match any alphanumeric characters after the @.
 # These characters are allowed in handles: _  .  -
 MENTINONED_USERS = rec(r"(\@(?P<handle>[\w_.'-]+))")
@@ -97,6 +118,9 @@ GIST_HTML = '<script src="https://gist.github.com/%s.js"></script>'
 # https://twitter.com/Linux/status/2311234267
 TWITTER_PATTERN = rec(r"http(s)?://(www)?.?twitter.com/\w+/status(es)?/(?P<uid>([\d]+))")
 
+# Shown until the embedded tweet is fetched.
+TWITTER_PLACEHOLDER = '<blockquote class="twitter-tweet"><a href="%s">%s</a></blockquote>'
+
 
 def get_tweet(tweet_id):
     """
@@ -108,12 +132,45 @@ def get_tweet(tweet_id):
     tweet_id -- a tweet's numeric id like 2311234267 for the tweet at
     https://twitter.com/Linux/status/2311234267
     """
-    try:
-        response = requests.get("https://api.twitter.com/1/statuses/oembed.json?id={}".format(
-            tweet_id))
-        return response.json()['html']
-    except:
-        return ''
+    response = requests.get("https://api.twitter.com/1/statuses/oembed.json",
+                            params=dict(id=tweet_id), timeout=settings.EMBED_TIMEOUT)
+    return response.json()['html']
+
+
+def fetch_embed(url):
+    """
+    Default embed fetcher, returns the html that replaces the link.
+    """
+    match = TWITTER_PATTERN.search(url)
+    return get_tweet(match.group("uid"))
+
+
+def fetch_embeds(text):
+    """
+    Fetches the missing and expired embeds for the links in the text.
+    Returns the number of embeds stored.
+    """
+    urls = {m.group(0) for m in TWITTER_PATTERN.finditer(text or "")}
+    if not urls:
+        return 0
+
+    fresh = util.now() - timedelta(seconds=settings.EMBED_CACHE_SECS)
+    fresh = set(Embed.objects.filter(url__in=urls, date__gt=fresh).values_list("url", flat=True))
+
+    fetcher = import_string(settings.EMBED_FETCHER)
+
+    count = 0
+    for url in urls - fresh:
+        try:
+            html = fetcher(url)
+        except Exception as exc:
+            logger.warning(f"Unable to embed {url}: {exc}")
+            continue
+        Embed.objects.update_or_create(url=url, defaults=dict(html=html, date=util.now()))
+        bump_refs("embed", url)
+        count += 1
+
+    return count
 
 
 class MonkeyPatch(InlineLexer):
@@ -182,17 +239,32 @@ def rewrite_static(link):
 class BiostarInlineLexer(MonkeyPatch):
     grammar_class = BiostarInlineGrammer
 
-    def __init__(self, root=None, allow_rewrite=False, *args, **kwargs):
+    def __init__(self, allow_rewrite=False, *args, **kwargs):
         """
-        :param root: Root post that is being pared
-        :param static_imgs:
+        :param allow_rewrite: Serve images with relative paths from the static directory.
         """
-        self.root = root
         self.allow_rewrite = allow_rewrite
 
+        # Users mentioned in the text being rendered.
+        self.mentioned = []
+
+        # Users, post titles and profile names referenced by the text, set by resolve().
+        self.users, self.titles, self.names = {}, {}, {}
+
+        # Embedded html by link, and the links that still need to be fetched.
+        self.embeds, self.pending = {}, []
+
         super(BiostarInlineLexer, self).__init__(*args, **kwargs)
         self.enable_all()
 
+    def resolve(self, refs):
+        """
+        Uses the users, posts and embeds looked up for the text being rendered.
+        """
+        self.mentioned, self.pending = [], []
+        self.users, self.titles, self.names = refs["users"], refs["titles"], refs["names"]
+        self.embeds = refs["embeds"]
+
     def enable_all(self):
         self.enable_post_link()
         self.enable_mention_link()
@@ -231,15 +303,14 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_mention_link(self, m):
 
         handle = m.group("handle")
-        # Query user and get the link
-        user = User.objects.filter(username=handle).first()
+        # User looked up in the pre-pass.
+        user = self.users.get(handle)
         if user:
-            profile = reverse("user_profile", kwargs=dict(uid=user.profile.uid))
-            link = f'<a href="{profile}">{user.profile.name}</a>'
-            # Subscribe mentioned users to post.
-            if self.root:
-                # Create user subscription if it does not already exist.
-                auth.create_subscription(post=self.root, user=user, update=True)
+            user_id, uid, name = user
+            profile = reverse("user_profile", kwargs=dict(uid=uid))
+            link = f'<a href="{profile}">{name}</a>'
+            # Mentioned users get subscribed to the post after rendering.
+            self.mentioned.append(user_id)
         else:
             link = m.group(0)
 
@@ -247,9 +318,9 @@ class BiostarInlineLexer(MonkeyPatch):
 
     def output_post_link(self, m):
         uid = m.group("uid")
-        post = Post.objects.filter(uid=uid).first() or Post(title=f"Invalid post uid: {uid}")
+        title = self.titles.get(uid, f"Invalid post uid: {uid}")
         link = m.group(0)
-        return f'<a href="{link}">{post.title}</a>'
+        return f'<a href="{link}">{title}</a>'
 
     def enable_anchor_link(self):
         self.rules.anchor_link = POST_ANCHOR
@@ -258,8 +329,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_anchor_link(self, m):
         uid = m.group("uid")
         alt, link = f"{uid}", m.group(0)
-        post = Post.objects.filter(uid=uid).first()
-        title = post.title if post else "Post not found"
+        title = self.titles.get(uid, "Post not found")
         return f'<a href="{link}">{title}</a>'
 
     def enable_user_link(self):
@@ -269,8 +339,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_user_link(self, m):
         uid = m.group("uid")
         link = m.group(0)
-        profile = Profile.objects.filter(uid=uid).first()
-        name = profile.name if profile else f"Invalid user uid: {uid}"
+        name = self.names.get(uid, f"Invalid user uid: {uid}")
         return f'<a href="{link}">USER: {name}</a>'
 
     def enable_youtube_link1(self):
@@ -302,8 +371,14 @@ class BiostarInlineLexer(MonkeyPatch):
         self.default_rules.insert(1, 'twitter_link')
 
     def output_twitter_link(self, m):
-        uid = m.group("uid")
-        return get_tweet(uid)
+        url = m.group(0)
+        html, fresh = self.embeds.get(url, (None, False))
+
+        # Expired embeds are shown until fetched again.
+        if not fresh:
+            self.pending.append(url)
+
+        return html or TWITTER_PLACEHOLDER % (url, url)
 
     def enable_gist_link(self):
         self.rules.gist_link = GIST_PATTERN
@@ -322,6 +397,112 @@ class BiostarInlineLexer(MonkeyPatch):
         return f'<a href="{link}">{link}</a>'
 
 
+def ref_key(kind, value):
+    """
+    Version key of a user, post, profile or embed that rendered html refers to.
+    """
+    # Links may be longer than the key column.
+    if kind == "embed":
+        value = hashlib.md5(value.encode("utf-8")).hexdigest()
+    return f"{const.MARKDOWN_REF_KEY}-{kind}-{value}"
+
+
+def bump_refs(kind, *values):
+    """
+    Moves the html that refers to the values to a new version.
+    """
+    for value in values:
+        auth.bump_version(ref_key(kind, value))
+
+
+def ref_keys(text):
+    """
+    Collects the version keys of every handle, uid and embedded link in the text.
+    """
+    keys = {ref_key("user", m.group("handle")) for m in MENTINONED_USERS.finditer(text)}
+    for m in POST_UIDS.finditer(text):
+        keys.update(ref_key("post", uid) for uid in m.group("uid", "anchor") if uid)
+    keys.update(ref_key("profile", m.group("uid")) for m in USER_UIDS.finditer(text))
+    keys.update(ref_key("embed", m.group(0)) for m in TWITTER_PATTERN.finditer(text))
+    return keys
+
+
+def lookup(text):
+    """
+    Collects every handle, uid and embedded link in the text and looks them up with one query per kind.
+    The rendered html depends on the database only through the values returned here.
+    """
+    handles = {m.group("handle") for m in MENTINONED_USERS.finditer(text)}
+    users = User.objects.filter(username__in=handles) if handles else User.objects.none()
+    users = users.values_list("username", "id", "profile__uid", "profile__name")
+    users = {username: (pk, uid, name) for username, pk, uid, name in users}
+
+    uids = set()
+    for m in POST_UIDS.finditer(text):
+        uids.update(uid for uid in m.group("uid", "anchor") if uid)
+    posts = Post.objects.filter(uid__in=uids).values_list("uid", "title") if uids else []
+    titles = dict(posts)
+
+    uids = {m.group("uid") for m in USER_UIDS.finditer(text)}
+    profiles = Profile.objects.filter(uid__in=uids).values_list("uid", "name") if uids else []
+    names = dict(profiles)
+
+    urls = {m.group(0) for m in TWITTER_PATTERN.finditer(text)}
+    embeds = Embed.objects.filter(url__in=urls).values_list("url", "html", "date") if urls else []
+    fresh = util.now() - timedelta(seconds=settings.EMBED_CACHE_SECS)
+    embeds = {url: (html, date > fresh) for url, html, date in embeds}
+
+    return dict(users=users, titles=titles, names=names, embeds=embeds)
+
+
+def get_parser(escape=True, allow_rewrite=False):
+    """
+    Returns the markdown parser of the current thread for the given options.
+    """
+    parsers = PARSERS.__dict__.setdefault("parsers", {})
+    key = (escape, allow_rewrite)
+
+    if key not in parsers:
+        # parse_block_html=True ensures '>','<', etc are dealt with without being escaped.
+        renderer = BiostarRenderer(escape=escape, parse_block_html=True)
+        inline = BiostarInlineLexer(renderer=renderer, allow_rewrite=allow_rewrite)
+        parsers[key] = mistune.Markdown(hard_wrap=True, renderer=renderer, inline=inline)
+
+    return parsers[key]
+
+
+def get_cleaner():
+    """
+    Returns the bleach cleaner of the current thread.
+    """
+    if not hasattr(PARSERS, "cleaner"):
+        PARSERS.cleaner = bleach.Cleaner(tags=ALLOWED_TAGS, styles=ALLOWED_STYLES,
+                                         attributes=ALLOWED_ATTRIBUTES)
+    return PARSERS.cleaner
+
+
+def render(text, clean=True, escape=True, allow_rewrite=False, refs=None):
+    """
+    Renders markdown into html without the cache, refs are the values returned by lookup().
+    Returns the html, the ids of the mentioned users and the embedded links not yet fetched.
+    """
+    # Bleach clean the text before handing it over to mistune.
+    if clean:
+        # strip=True strips all disallowed elements
+        text = get_cleaner().clean(text)
+
+    markdown = get_parser(escape=escape, allow_rewrite=allow_rewrite)
+
+    # Look up all users and posts referenced in the text before rendering.
+    refs = lookup(text) if refs is None else refs
+    markdown.inline.resolve(refs)
+
+    # Create final html.
+    html = markdown(text)
+
+    return html, markdown.inline.mentioned, markdown.inline.pending
+
+
 def parse(text, post=None, clean=True, escape=True, allow_rewrite=False):
     """
     Parses markdown into html.
@@ -332,32 +513,81 @@ def parse(text, post=None, clean=True, escape=True, allow_rewrite=False):
     escape  : Escape html originally found in the markdown text.
     allow_rewrite : Serve images with relative url paths from the static directory.
                   eg. images/foo.png -> /static/images/foo.png
+
+    The html is cached by the hash of the text and of the versions of the users, posts
+    and embeds it refers to, so unchanged content is not parsed again. Html with
+    placeholders for embeds that are not yet fetched is not cached.
     """
 
     # Resolve the root if exists.
     root = post.parent.root if (post and post.parent) else None
 
-    # Bleach clean the text before handing it over to mistune.
-    if clean:
-        # strip=True strips all disallowed elements
-        text = bleach.clean(text, tags=ALLOWED_TAGS, styles=ALLOWED_STYLES,
-                            attributes=ALLOWED_ATTRIBUTES)
+    # Renamed users and retitled posts move their references to a new version.
+    keys = ref_keys(text)
+    versions = auth.cache_versions(keys) if keys else {}
 
-    # Initialize the renderer
-    # parse_block_html=True ensures '>','<', etc are dealt with without being escaped.
-    renderer = BiostarRenderer(escape=escape, parse_block_html=True)
+    # Same text, options and reference versions render the same html.
+    versions = json.dumps(versions, sort_keys=True)
+    digest = f"{RENDER_VERSION}-{clean}-{escape}-{allow_rewrite}-{versions}-{text}"
+    digest = hashlib.md5(digest.encode("utf-8")).hexdigest()
+    key = f"{const.MARKDOWN_CACHE_KEY}-{digest}"
 
-    # Initialize the lexer 
-    inline = BiostarInlineLexer(renderer=renderer, root=root, allow_rewrite=allow_rewrite)
+    cached = cache.get(key)
+    if cached is None:
+        html, mentioned, pending = render(text, clean=clean, escape=escape, allow_rewrite=allow_rewrite)
+        cached = (html, mentioned)
+        if not pending:
+            cache.set(key, cached, settings.MARKDOWN_CACHE_SECS)
 
-    markdown = mistune.Markdown(hard_wrap=True, renderer=renderer, inline=inline)
+    html, mentioned = cached
 
-    # Create final html.
-    html = markdown(text)
+    # Subscribe mentioned users to post.
+    if root and mentioned:
+        users = User.objects.filter(id__in=mentioned).select_related("profile")
+        auth.create_subscriptions(post=root, users=users)
 
     return html
 
 
+def render_partition(ids):
+    """
+    Renders the html for a partition of post ids in a separate process.
+    """
+    # Database connections may not be shared with the parent process.
+    connections.close_all()
+
+    posts = Post.objects.filter(id__in=ids).values_list("id", "content", "html")
+    changed = []
+    for pk, content, old in posts:
+        html, mentioned, pending = render(content, clean=True, escape=False)
+        if html != old:
+            changed.append((pk, html))
+
+    return changed
+
+
+def rerender(workers=4, size=1000):
+    """
+    Regenerates the html of every post with a process pool.
+    The rendering runs in parallel, the changes are stored by the calling process.
+    Returns the number of posts updated.
+    """
+    ids = list(Post.objects.order_by("id").values_list("id", flat=True))
+    parts = [ids[i:i + size] for i in range(0, len(ids), size)]
+
+    # Forked processes must open their own database connections.
+    connections.close_all()
+
+    total = 0
+    with multiprocessing.Pool(processes=workers) as pool:
+        for changed in pool.imap_unordered(render_partition, parts):
+            objs = [Post(id=pk, html=html) for pk, html in changed]
+            Post.objects.bulk_update(objs, ["html"], batch_size=size)
+            total += len(objs)
+
+    return total
+
+
 def test():
     html = parse(TEST_INPUT2)
     return html
@@ -8,6 +8,7 @@ from django.core.cache import cache
 from django.shortcuts import redirect
 from biostar.accounts.models import Profile, Message
 from biostar.accounts.tasks import detect_location
+from biostar.utils import decorators
 
 from . import auth, tasks, const, util
 from .models import Vote
@@ -150,8 +151,10 @@ def user_tasks(get_response):
             # Set the session.
             request.session[const.COUNT_DATA_KEY] = counts
 
-            tasks.create_user_awards.spool(user_id=user.id)
-            # Can process response here after its been handled by the view
+            # Awards are created for all recent visitors by the create_awards timer.
+            # Without running timers the awards of each visitor are created right away.
+            if not decorators.timers_running():
+                tasks.create_user_awards.spool(user_id=user.id)
 
         # Can process response here after its been handled by the view
 
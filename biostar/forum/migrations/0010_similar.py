@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 01:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0009_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarPosts',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.TextField(default='[]')),
+                ('date', models.DateTimeField()),
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='similar', to='forum.Post')),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.7 on 2026-10-18 02:47
+
+from django.db import migrations, models
+from django.db.models import Q
+
+# Post.OPEN, Post.NOT_SPAM and Post.DEFAULT at the time of the migration.
+OPEN, NOT_SPAM, DEFAULT = 1, 1, 2
+
+
+def hide_posts(apps, schema_editor):
+    """
+    Hide the existing posts that valid_posts used to filter out.
+    """
+    Post = apps.get_model('forum', 'Post')
+    valid = [NOT_SPAM, DEFAULT]
+    visible = Q(status=OPEN, root__status=OPEN) & (Q(spam__in=valid) | Q(root__spam__in=valid))
+    Post.objects.exclude(visible).update(is_visible=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0011_embed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='is_visible',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_visible', 'rank'], name='post_visible_rank'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['is_visible', 'lastedit_date'], name='post_visible_edit'),
+        ),
+        migrations.RunPython(hide_posts, migrations.RunPython.noop),
+    ]
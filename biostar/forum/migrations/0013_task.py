@@ -0,0 +1,34 @@
+# Generated by Django 3.0.7 on 2026-10-18 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0012_visible'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('data', models.BinaryField()),
+                ('key', models.CharField(blank=True, db_index=True, max_length=200, null=True)),
+                ('priority', models.IntegerField(default=0)),
+                ('state', models.IntegerField(choices=[(0, 'Queued'), (1, 'Running'), (2, 'Failed')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_after', models.DateTimeField()),
+                ('lease_until', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(default='', max_length=200)),
+                ('error', models.TextField(default='')),
+                ('date', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['state', '-priority', 'run_after'], name='task_pending'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0014_cacheversion'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(condition=models.Q(state=0), fields=('key',), name='task_queued_key'),
+        ),
+    ]
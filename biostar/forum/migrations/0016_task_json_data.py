@@ -0,0 +1,27 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:14
+
+from django.db import migrations, models
+
+
+def remove_tasks(apps, schema_editor):
+    """
+    Remove the tasks stored with pickled arguments, they can not be read as JSON.
+    """
+    Task = apps.get_model('forum', 'Task')
+    Task.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0015_task_queued_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_tasks, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='task',
+            name='data',
+            field=models.TextField(),
+        ),
+    ]
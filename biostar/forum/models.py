@@ -4,8 +4,8 @@ import bleach
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, Count
 from django.shortcuts import reverse
 from taggit.managers import TaggableManager
 from biostar.accounts.models import Profile
@@ -36,14 +36,29 @@ class PostManager(models.Manager):
             return query
 
         # Filter for open posts that are not spam.
-        query = query.filter(status=Post.OPEN, root__status=Post.OPEN)
-        query = query.filter(models.Q(spam=Post.NOT_SPAM) | models.Q(spam=Post.DEFAULT) |
-                             models.Q(root__spam=Post.NOT_SPAM) | models.Q(root__spam=Post.DEFAULT))
+        query = query.filter(is_visible=True)
 
         query = query.exclude(root=None)
 
         return query
 
+    def update_visibility(self, **kwargs):
+        """
+        Recomputes the is_visible flag of the posts matching the filters.
+        Posts are visible when they and their root are open, and either one is not spam.
+        Returns the number of posts that changed.
+        """
+        valid = [Post.NOT_SPAM, Post.DEFAULT]
+        visible = Q(status=Post.OPEN, root__status=Post.OPEN) & (Q(spam__in=valid) | Q(root__spam__in=valid))
+
+        query = super().get_queryset().filter(**kwargs)
+
+        # Only write the posts that change.
+        shown = query.filter(visible, is_visible=False).update(is_visible=True)
+        hidden = query.exclude(visible).filter(is_visible=True).update(is_visible=False)
+
+        return shown + hidden
+
     def old(self, **kwargs):
         """
         Return posts that were transferred over from an older verion of biostars
@@ -73,6 +88,15 @@ class Sync(models.Model):
     last_synced = models.DateTimeField(null=True)
 
 
+class CacheVersion(models.Model):
+    """
+    Version of cached content shared by every process, bumped when the content changes.
+    """
+    key = models.CharField(max_length=200, unique=True)
+
+    value = models.BigIntegerField(default=0)
+
+
 class Post(models.Model):
     "Represents a post in a forum"
 
@@ -137,6 +161,9 @@ class Post(models.Model):
     # Show that post is top level
     is_toplevel = models.BooleanField(default=False, db_index=True)
 
+    # Open and not spam within an open thread, maintained by update_visibility.
+    is_visible = models.BooleanField(default=True)
+
     # Indicates whether the post has accepted answer.
     answer_count = models.IntegerField(default=0, blank=True, db_index=True)
 
@@ -199,6 +226,13 @@ class Post(models.Model):
 
     objects = PostManager()
 
+    class Meta:
+        indexes = [
+            # Listings of visible posts ordered by rank or by edit date.
+            models.Index(fields=["is_visible", "rank"], name="post_visible_rank"),
+            models.Index(fields=["is_visible", "lastedit_date"], name="post_visible_edit"),
+        ]
+
     def parse_tags(self):
         return [tag.lower() for tag in self.tag_val.split(",") if tag]
 
@@ -231,13 +265,8 @@ class Post(models.Model):
         return self.status == Post.OPEN and not self.is_spam and not self.suspect_spam
 
     def recompute_scores(self):
-        # Recompute answers count
-        if self.type == Post.ANSWER:
-            answer_count = Post.objects.filter(root=self.root, type=Post.ANSWER).count()
-            Post.objects.filter(pk=self.parent_id).update(answer_count=answer_count)
-
-        reply_count = Post.objects.filter(root=self.root).count()
-        Post.objects.filter(pk=self.root.id).update(reply_count=reply_count)
+        # Same counts as when the post was added to the thread.
+        self.update_parent_counts()
 
     def json_data(self):
         data = {
@@ -331,6 +360,10 @@ class Post(models.Model):
         self.lastedit_date = self.lastedit_date or util.now()
         self.last_contributor = self.lastedit_user
 
+        # Place new posts in the thread before the first insert.
+        if self._state.adding:
+            self.prepare()
+
         # Sanitize the post body.
         self.html = markdown.parse(self.content, post=self, clean=True, escape=False)
         self.tag_val = self.tag_val.replace(' ', '')
@@ -339,32 +372,81 @@ class Post(models.Model):
         # Set the top level state of the post.
         self.is_toplevel = self.type in Post.TOP_LEVEL
 
-        # This will trigger the signals
-        super(Post, self).save(*args, **kwargs)
+        # The insert and the thread updates done by the signals are a single transaction.
+        with transaction.atomic():
+            # This will trigger the signals
+            super(Post, self).save(*args, **kwargs)
+
+    def prepare(self):
+        """
+        Sets the root, type, title, rank and visibility of a new post.
+        The uid, root and parent of top level posts depend on the primary key and are set after the insert.
+        """
+        # Temporary unique uid, replaced with one made from the primary key.
+        self.uid_from_pk = not self.uid
+        self.uid = self.uid or util.get_uuid(limit=32)
+
+        # When there is no parent, root and parent are set to itself after the insert.
+        parent = self.parent or self
+
+        # When the parent is set the root must follow the parent root.
+        if self.parent:
+            self.root = self.parent.root
+        root = self.root if self.parent else self
+
+        # Answers and comments may only have comments associated with them.
+        if parent.type in (Post.ANSWER, Post.COMMENT):
+            self.type = Post.COMMENT
+
+        # Title is inherited from top level.
+        if self.type not in Post.TOP_LEVEL:
+            self.title = "%s: %s" % (self.get_type_display(), root.title[:80])
+
+        # Update this post rank on create and not every edit.
+        self.rank = self.lastedit_date.timestamp()
+
+        # Same rule as PostManager.update_visibility.
+        valid = (Post.NOT_SPAM, Post.DEFAULT)
+        self.is_visible = (self.status == Post.OPEN and root.status == Post.OPEN and
+                           (self.spam in valid or root.spam in valid))
 
     def __str__(self):
         return "%s: %s (pk=%s)" % (self.get_type_display(), self.title, self.pk)
 
-    def update_parent_counts(self):
+    def update_parent_counts(self, **fields):
         """
         Update the counts for the parent and root
+        Other fields given are set on the root in the same statement.
         """
 
-        descendants = Post.objects.filter(root=self.root).exclude(Q(pk=self.root.pk) | Q(status=Post.DELETED)
-                                                                  | Q(spam=Post.SPAM))
-        answer_count = descendants.filter(type=Post.ANSWER).count()
-        comment_count = descendants.filter(type=Post.COMMENT).count()
-        reply_count = descendants.count()
+        # Descendants of the root that are not deleted or spam.
+        descendants = ~Q(pk=self.root_id) & ~Q(status=Post.DELETED) & ~Q(spam=Post.SPAM)
+
+        # Children of the parent, excluding itself.
+        children = Q(parent_id=self.parent_id) & ~Q(pk=self.parent_id)
+
+        # Count everything with a single pass over the thread.
+        counts = Post.objects.filter(root_id=self.root_id).aggregate(
+            reply_count=Count("id", filter=descendants),
+            answer_count=Count("id", filter=descendants & Q(type=Post.ANSWER)),
+            comment_count=Count("id", filter=descendants & Q(type=Post.COMMENT)),
+            child_count=Count("id", filter=children),
+            child_comments=Count("id", filter=children & Q(type=Post.COMMENT)),
+        )
+
         # Update the root reply, answer, and comment counts.
-        Post.objects.filter(pk=self.root.pk).update(reply_count=reply_count, answer_count=answer_count,
-                                                    comment_count=comment_count)
+        Post.objects.filter(pk=self.root_id).update(reply_count=counts['reply_count'],
+                                                    answer_count=counts['answer_count'],
+                                                    comment_count=counts['comment_count'], **fields)
 
-        children = Post.objects.filter(parent=self.parent).exclude(pk=self.parent.pk)
-        com_count = children.filter(type=Post.COMMENT).count()
+        # The root has no parent to update.
+        if self.parent_id == self.root_id:
+            return
 
         # Update parent reply, answer, and comment counts.
-        Post.objects.filter(pk=self.parent.pk, is_toplevel=False).update(comment_count=com_count, answer_count=0,
-                                                                         reply_count=children.count())
+        Post.objects.filter(pk=self.parent_id, is_toplevel=False).update(comment_count=counts['child_comments'],
+                                                                         answer_count=0,
+                                                                         reply_count=counts['child_count'])
 
     @property
     def css(self):
@@ -391,6 +473,96 @@ class Post(models.Model):
         return delta.days
 
 
+class SimilarPosts(models.Model):
+    """
+    Top level posts similar to a post, computed in the background when the post is indexed.
+    """
+    post = models.OneToOneField(Post, related_name="similar", on_delete=models.CASCADE)
+
+    # JSON list with the uid, title, url and content of each similar post.
+    data = models.TextField(default="[]")
+
+    # When the similar posts were last computed.
+    date = models.DateTimeField()
+
+    def save(self, *args, **kwargs):
+        self.date = self.date or util.now()
+        super(SimilarPosts, self).save(*args, **kwargs)
+
+
+class Embed(models.Model):
+    """
+    Html of an embedded link fetched in the background, keyed by the link.
+    """
+    url = models.CharField(max_length=255, unique=True)
+
+    # Html shown in place of the link.
+    html = models.TextField(default="")
+
+    # When the html was last fetched.
+    date = models.DateTimeField()
+
+    def save(self, *args, **kwargs):
+        self.date = self.date or util.now()
+        super(Embed, self).save(*args, **kwargs)
+
+
+class Task(models.Model):
+    """
+    A spooled task stored in the database and run by the worker command.
+    """
+    QUEUED, RUNNING, FAILED = range(3)
+    STATE_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (FAILED, "Failed")]
+
+    # Dotted path to the spooled function.
+    name = models.CharField(max_length=200)
+
+    # JSON encoded positional and keyword arguments.
+    data = models.TextField()
+
+    # Tasks with the same key are queued only once, the last arguments win.
+    key = models.CharField(max_length=200, null=True, blank=True, db_index=True)
+
+    # Tasks with higher priority run first.
+    priority = models.IntegerField(default=0)
+
+    state = models.IntegerField(choices=STATE_CHOICES, default=QUEUED)
+
+    # Number of times the task has been started.
+    attempts = models.IntegerField(default=0)
+
+    # The task is not started before this date.
+    run_after = models.DateTimeField()
+
+    # A running task is taken over by another worker after its lease ends.
+    lease_until = models.DateTimeField(null=True, blank=True)
+
+    # The worker running the task.
+    worker = models.CharField(max_length=200, default="")
+
+    # The error of the last failed attempt.
+    error = models.TextField(default="")
+
+    date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', '-priority', 'run_after'], name='task_pending'),
+        ]
+        constraints = [
+            # One queued task per key, enforced by the database for concurrent callers. State 0 is QUEUED.
+            models.UniqueConstraint(fields=['key'], condition=models.Q(state=0), name='task_queued_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_state_display()})"
+
+    def save(self, *args, **kwargs):
+        self.date = self.date or util.now()
+        self.run_after = self.run_after or self.date
+        super(Task, self).save(*args, **kwargs)
+
+
 class Vote(models.Model):
     # Post statuses.
 
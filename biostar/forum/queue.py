@@ -0,0 +1,196 @@
+"""
+Spooled tasks kept in the database and run by the worker command.
+
+Enable with TASK_QUEUE = "biostar.forum.queue.enqueue" and start one or more
+workers with: python manage.py worker --workers 4
+"""
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils.module_loading import import_string
+
+from biostar.forum import util
+from biostar.forum.models import Task
+
+logger = logging.getLogger('engine')
+
+# The task run by the current thread, tasks raise their errors so that they are retried.
+CURRENT = threading.local()
+
+
+def task_name(func):
+    """
+    Dotted path the worker imports the task from.
+    """
+    return f"{func.__module__}.{func.__name__}"
+
+
+def is_running():
+    """
+    True while the current thread runs a task from the queue.
+    """
+    return getattr(CURRENT, 'task', None) is not None
+
+
+def enqueue(func, args=(), kwargs=None, key=None, priority=None, delay=0):
+    """
+    Stores a task in the database.
+    Returns None when a task with the same key is already queued, that task runs with the new arguments.
+    The arguments must be JSON serializable, tasks take ids and fetch the rows when they run.
+    """
+    kwargs = kwargs or {}
+
+    # Options set on the task with the task_options decorator.
+    priority = getattr(func, 'queue_priority', 0) if priority is None else priority
+    make_key = getattr(func, 'queue_key', None)
+    if key is None and make_key:
+        key = make_key(*args, **kwargs)
+
+    data = json.dumps(dict(args=list(args), kwargs=kwargs))
+
+    # Queue the same work once, with the latest arguments.
+    queued = Task.objects.filter(key=key, state=Task.QUEUED)
+    if key and queued.update(data=data):
+        return None
+
+    run_after = util.now() + timedelta(seconds=delay)
+    try:
+        with transaction.atomic():
+            task = Task.objects.create(name=task_name(func), data=data, key=key, priority=priority,
+                                       run_after=run_after)
+    except IntegrityError:
+        # Another caller queued the same key in the meantime.
+        queued.update(data=data)
+        return None
+
+    return task
+
+
+def schedule(timers):
+    """
+    Queues the next run of each timer, the key keeps a single run queued across all workers and hosts.
+    Timers are (secs, func, target) as declared with the timer decorator. Returns the number of runs queued.
+    """
+    total = 0
+    for secs, func, target in timers:
+        key = f"timer-{task_name(func)}"
+
+        # The next run is queued once the running one is done.
+        if Task.objects.filter(key=key, state=Task.RUNNING).exists():
+            continue
+
+        total += bool(enqueue(func, key=key, delay=secs))
+
+    return total
+
+
+def claim(worker):
+    """
+    Leases the next pending task to the worker. Returns None when there is nothing to run.
+    """
+    now = util.now()
+    lease = now + timedelta(seconds=settings.TASK_LEASE_SECS)
+
+    # Queued tasks that are due and running tasks whose worker went away.
+    pending = Q(state=Task.QUEUED, run_after__lte=now) | Q(state=Task.RUNNING, lease_until__lt=now)
+    candidates = Task.objects.filter(pending).order_by('-priority', 'run_after', 'pk')
+    candidates = candidates.values_list('pk', 'state', 'lease_until')[:10]
+
+    for pk, state, lease_until in candidates:
+        # Take the task only if no other worker changed it in the meantime.
+        taken = Task.objects.filter(pk=pk, state=state, lease_until=lease_until).update(
+            state=Task.RUNNING, lease_until=lease, worker=worker, attempts=F('attempts') + 1)
+        if taken:
+            return Task.objects.filter(pk=pk).first()
+
+    return None
+
+
+def fail(task, error):
+    """
+    Queues the task again with a growing delay, or marks it as failed after the last attempt.
+    """
+    if task.attempts >= settings.TASK_MAX_ATTEMPTS:
+        changes = dict(state=Task.FAILED)
+    else:
+        delay = settings.TASK_RETRY_SECS * 2 ** (task.attempts - 1)
+        changes = dict(state=Task.QUEUED, run_after=util.now() + timedelta(seconds=delay))
+
+    logger.error(f"task {task.name} attempt {task.attempts} failed: {error}")
+
+    owned = Task.objects.filter(pk=task.pk, worker=task.worker)
+    try:
+        with transaction.atomic():
+            owned.update(lease_until=None, error=str(error), **changes)
+    except IntegrityError:
+        # The same work was queued again while running, the new task replaces this one.
+        owned.delete()
+
+
+def renew(task, stop):
+    """
+    Extends the lease of a running task until stopped.
+    """
+    while not stop.wait(settings.TASK_LEASE_SECS / 3):
+        lease = util.now() + timedelta(seconds=settings.TASK_LEASE_SECS)
+        Task.objects.filter(pk=task.pk, worker=task.worker, state=Task.RUNNING).update(lease_until=lease)
+
+
+def keep_lease(task, stop):
+    """
+    Renews the lease from a thread, with a database connection of its own.
+    """
+    try:
+        renew(task, stop)
+    finally:
+        connection.close()
+
+
+def run(task):
+    """
+    Runs a claimed task, a finished task is removed from the queue.
+    """
+    # Tasks taken over from a crashed worker may crash the worker again.
+    if task.attempts > settings.TASK_MAX_ATTEMPTS:
+        fail(task, "Worker stopped while running the task.")
+        return False
+
+    # Long tasks keep their lease while running.
+    stop = threading.Event()
+    threading.Thread(target=keep_lease, args=(task, stop), daemon=True).start()
+
+    CURRENT.task = task
+    try:
+        func = import_string(task.name)
+        # Call the function under the spool decorator.
+        func = getattr(func, '__wrapped__', func)
+        data = json.loads(task.data)
+        func(*data['args'], **data['kwargs'])
+    except Exception as exc:
+        fail(task, exc)
+        return False
+    finally:
+        CURRENT.task = None
+        stop.set()
+
+    Task.objects.filter(pk=task.pk, worker=task.worker).delete()
+    return True
+
+
+def drain(worker):
+    """
+    Runs tasks until none is pending, returns the number of tasks run.
+    """
+    total = 0
+
+    while True:
+        task = claim(worker)
+        if not task:
+            return total
+        run(task)
+        total += 1
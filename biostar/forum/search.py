@@ -1,15 +1,26 @@
+import glob
+import hashlib
+import json
 import logging
+import math
+import multiprocessing
 import os
+import shutil
 import time
+import threading
 from itertools import count, islice
 from collections import defaultdict
 
 # Postgres specific queries should go into separate module.
 from django.conf import settings
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q, Min, Max
+from django.shortcuts import reverse
 from whoosh import writing, classify
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.writing import AsyncWriter
+from whoosh.util.filelock import FileLock
 from whoosh.searching import Results
 
 from whoosh.qparser import MultifieldParser, OrGroup
@@ -17,7 +28,9 @@ from whoosh.analysis import STOP_WORDS
 from whoosh.index import create_in, open_dir, exists_in
 from whoosh.fields import ID, TEXT, KEYWORD, Schema, BOOLEAN, NUMERIC, DATETIME
 
-from biostar.forum.models import Post
+from biostar.accounts.models import Profile
+from biostar.forum.models import Post, SimilarPosts
+from biostar.forum import util, const
 
 logger = logging.getLogger('biostar')
 
@@ -25,7 +38,6 @@ logger = logging.getLogger('biostar')
 STOP = ['there', 'where', 'who', 'that'] + [w for w in STOP_WORDS]
 STOP = set(STOP)
 
-
 def timer_func():
     """
     Prints progress on inserting elements.
@@ -84,6 +96,28 @@ class SearchResult(object):
         return self.total
 
 
+class SearchPage(object):
+    """
+    A page of search results that can be stored in the cache.
+    Hits are the stored fields of each matching document.
+    """
+
+    def __init__(self, hits, total=0, pagenum=1, pagecount=1):
+        self.hits = hits
+        self.total = total
+        self.pagenum = pagenum
+        self.pagecount = pagecount
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def is_last_page(self):
+        return self.pagecount == 0 or self.pagenum == self.pagecount
+
+    def __len__(self):
+        return len(self.hits)
+
+
 def normalize_result(result):
     "Return a bunch object for result."
 
@@ -139,6 +173,87 @@ def add_index(post, writer):
                            lastedit_user_is_moderator=post.lastedit_user.profile.is_moderator)
 
 
+# Pre-joined columns needed to build a search document.
+ROW_FIELDS = [
+    'id', 'uid', 'title', 'type', 'content', 'tag_val', 'is_toplevel', 'rank', 'vote_count',
+    'reply_count', 'view_count', 'thread_votecount', 'creation_date', 'lastedit_date',
+    'author__username', 'author__email', 'author__is_staff', 'author__is_superuser',
+    'author__profile__name', 'author__profile__uid', 'author__profile__score',
+    'author__profile__role', 'author__profile__state',
+    'lastedit_user__is_staff', 'lastedit_user__is_superuser',
+    'lastedit_user__profile__name', 'lastedit_user__profile__uid',
+    'lastedit_user__profile__role', 'lastedit_user__profile__state',
+    'root__uid', 'root__answer_count', 'root__accept_count',
+]
+
+TYPE_DISPLAY = dict(Post.TYPE_CHOICES)
+
+MODERATOR_ROLES = {Profile.MODERATOR, Profile.MANAGER}
+
+
+def post_rows(posts, chunk_size=2000):
+    """
+    Streams posts as pre-joined value rows without creating model instances.
+    """
+    return posts.values(*ROW_FIELDS).iterator(chunk_size=chunk_size)
+
+
+def build_document(row):
+    """
+    Returns the search document for a post value row, mirrors add_index().
+    """
+
+    def is_moderator(prefix):
+        return (row[f'{prefix}__profile__role'] in MODERATOR_ROLES or row[f'{prefix}__is_staff']
+                or row[f'{prefix}__is_superuser'])
+
+    def is_suspended(prefix):
+        return row[f'{prefix}__profile__state'] == Profile.SUSPENDED
+
+    # Same as Post.get_absolute_url() and Profile.get_absolute_url()
+    url = reverse("post_view", kwargs=dict(uid=row['root__uid']))
+    url = url if row['is_toplevel'] else f"{url}#{row['uid']}"
+    author_url = reverse('user_profile', kwargs=dict(uid=row['author__profile__uid']))
+    lastedit_url = reverse('user_profile', kwargs=dict(uid=row['lastedit_user__profile__uid']))
+
+    doc = dict(title=row['title'], url=url,
+               type_display=TYPE_DISPLAY.get(row['type']),
+               content_length=len(row['content']),
+               type=row['type'],
+               creation_date=row['creation_date'],
+               lastedit_date=row['lastedit_date'],
+               lastedit_user=row['lastedit_user__profile__name'],
+               lastedit_user_email=row['author__email'],
+               lastedit_user_score=row['author__profile__score'],
+               lastedit_user_uid=row['author__profile__uid'],
+               lastedit_user_url=lastedit_url,
+               content=row['content'],
+               tags=row['tag_val'],
+               is_toplevel=row['is_toplevel'],
+               rank=row['rank'], uid=row['uid'],
+               vote_count=row['vote_count'],
+               reply_count=row['reply_count'],
+               view_count=row['view_count'],
+               author_handle=row['author__username'],
+               author=row['author__profile__name'],
+               answer_count=row['root__answer_count'],
+               root_has_accepted=bool(row['root__accept_count']),
+               author_email=row['author__email'],
+               author_score=row['author__profile__score'],
+               thread_votecount=row['thread_votecount'],
+               author_uid=row['author__profile__uid'],
+               author_url=author_url,
+               author_is_moderator=is_moderator('author'),
+               author_is_suspended=is_suspended('author'),
+               lastedit_user_is_suspended=is_suspended('lastedit_user'),
+               lastedit_user_is_moderator=is_moderator('lastedit_user'))
+    return doc
+
+
+def add_row(row, writer):
+    writer.update_document(**build_document(row))
+
+
 def get_schema():
     analyzer = StemmingAnalyzer(stoplist=STOP)
     schema = Schema(title=TEXT(stored=True, analyzer=analyzer, sortable=True),
@@ -194,16 +309,84 @@ def init_index(dirname=None, indexname=None, schema=None):
     return ix
 
 
+class SearcherPool(object):
+    """
+    Keeps an open searcher per thread and index, the searcher is refreshed
+    only when the index generation changes or the index directory is replaced.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    @staticmethod
+    def inode(dirname):
+        try:
+            return os.stat(dirname).st_ino
+        except OSError:
+            return None
+
+    def get(self, dirname=None, indexname=None, schema=None):
+        dirname = dirname or settings.INDEX_DIR
+        indexname = indexname or settings.INDEX_NAME
+        key = (dirname, indexname)
+
+        # Searchers may not be shared between threads.
+        searchers = self.local.__dict__.setdefault('searchers', {})
+        searcher, inode = searchers.get(key, (None, None))
+        current = self.inode(dirname)
+
+        if searcher and current and inode == current:
+            # Returns the same searcher when the generation has not changed.
+            fresh = searcher.refresh()
+        else:
+            # The directory has been removed or swapped for a new index.
+            if searcher:
+                searcher.close()
+            fresh = init_index(dirname=dirname, indexname=indexname, schema=schema).searcher()
+            current = self.inode(dirname)
+
+        searchers[key] = (fresh, current)
+
+        return fresh
+
+    def reset(self):
+        """
+        Forgets the searchers opened so far, forked processes must open their own.
+        """
+        self.local = threading.local()
+
+    def version(self, dirname=None, indexname=None):
+        """
+        Returns a name for the state of the index seen by the searcher.
+        Generations start over in a rebuilt index, the directory tells them apart.
+        """
+        dirname = dirname or settings.INDEX_DIR
+        generation = self.get(dirname=dirname, indexname=indexname).ixreader.generation()
+        name = os.path.basename(os.path.realpath(dirname))
+        return f"{name}-{self.inode(dirname)}-{generation}"
+
+
+# Per-process searcher pool.
+SEARCHERS = SearcherPool()
+
+
+def get_searcher(dirname=None, indexname=None, schema=None):
+    """
+    Returns an open searcher from the pool, do not close it.
+    """
+    return SEARCHERS.get(dirname=dirname, indexname=indexname, schema=schema)
+
+
 def print_info(dirname=None, indexname=None,):
     """
     Prints information on the index.
     """
     dirname = dirname or settings.INDEX_DIR
     indexname = indexname or settings.INDEX_NAME
-    ix = init_index(dirname=dirname, indexname=indexname)
+    searcher = get_searcher(dirname=dirname, indexname=indexname)
 
     counter = defaultdict(int)
-    for index, fields in enumerate(ix.searcher().all_stored_fields()):
+    for index, fields in enumerate(searcher.all_stored_fields()):
         key = fields['type_display']
         counter[key] += 1
 
@@ -244,6 +427,369 @@ def index_posts(posts, ix=None, overwrite=False, add_func=add_index):
     elapsed(f"Indexed posts={total}")
 
 
+def index_rows(posts, ix=None, overwrite=False):
+    """
+    Create or update a search index of posts streamed as value rows.
+    Returns the number of posts indexed.
+    """
+
+    ix = ix or init_index()
+    writer = AsyncWriter(ix)
+
+    elapsed, progress = timer_func()
+    total = posts.count()
+    stream = zip(count(1), post_rows(posts))
+
+    step = 0
+    for step, row in stream:
+        progress(step, total=total, msg="posts indexed")
+        add_row(row=row, writer=writer)
+
+    if overwrite:
+        logger.info("Overwriting the old index")
+        writer.commit(mergetype=writing.CLEAR)
+    else:
+        writer.commit()
+
+    elapsed(f"Indexed posts={step}")
+
+    return step
+
+
+def update_index(limit=None, overwrite=False):
+    """
+    Drains the queue of changed posts into the search index.
+
+    Posts are queued by setting their indexed flag to False, multiple edits
+    of the same post are coalesced into a single document update.
+    Returns the number of posts taken off the queue.
+    """
+    limit = limit or settings.BATCH_INDEXING_SIZE
+
+    # Posts stay queued while a full rebuild is running.
+    if is_rebuilding():
+        return 0
+
+    # Only one process claims the queued posts, concurrent calls skip this round.
+    lock = index_lock()
+    if not lock.acquire(blocking=False):
+        return 0
+
+    try:
+        # Posts that are queued for indexing.
+        queued = Post.objects.filter(indexed=False).exclude(root=None).order_by("lastedit_date")
+        ids = list(queued.values_list("id", flat=True)[:limit])
+
+        if not ids:
+            return 0
+
+        # Take the posts off the queue before indexing.
+        # Edits made while indexing will queue the post again.
+        Post.objects.filter(id__in=ids).update(indexed=True)
+
+        # Posts that should be searchable, all others are removed from the index.
+        valid = Post.objects.valid_posts(id__in=ids).exclude(spam=Post.SPAM)
+        valid = set(valid.values_list("id", flat=True))
+
+        uids = Post.objects.filter(id__in=ids).exclude(id__in=valid).values_list("uid", flat=True)
+        try:
+            ix = init_index()
+            # Waits for the write lock, similar posts below must see this commit.
+            writer = ix.writer(timeout=settings.INDEX_WRITER_SECS)
+            for row in post_rows(Post.objects.filter(id__in=valid)):
+                add_row(row=row, writer=writer)
+
+            for uid in uids:
+                writer.delete_by_term('uid', uid)
+
+            if overwrite:
+                writer.commit(mergetype=writing.CLEAR)
+            else:
+                writer.commit()
+        except Exception:
+            # Put the posts back on the queue.
+            Post.objects.filter(id__in=ids).update(indexed=False)
+            raise
+
+        # Similar posts are computed once the posts are searchable.
+        update_similar(ids=valid)
+
+    finally:
+        lock.release()
+
+    return len(ids)
+
+
+def build_partition(args):
+    """
+    Builds the index for posts within an id range into its own directory.
+    Runs in a separate process.
+    """
+    dirname, indexname, start, end = args
+
+    # Database connections may not be shared with the parent process.
+    connections.close_all()
+
+    ix = init_index(dirname=dirname, indexname=indexname)
+    writer = ix.writer(limitmb=settings.INDEX_LIMIT_MB)
+
+    posts = Post.objects.valid_posts(id__gte=start, id__lt=end).exclude(spam=Post.SPAM)
+    total = 0
+    for row in post_rows(posts):
+        add_row(row=row, writer=writer)
+        total += 1
+
+    writer.commit()
+
+    return dirname, total
+
+
+def index_lock(dirname=None):
+    """
+    File lock next to the index in dirname, held by the process that updates the index.
+    Each call returns a new lock, threads of the same process exclude each other as well.
+    """
+    return FileLock(f"{dirname or settings.INDEX_DIR}.lock")
+
+
+def rebuild_marker(dirname):
+    """
+    Path of the file that exists while the index in dirname is rebuilt.
+    """
+    return f"{dirname}.rebuilding"
+
+
+def is_rebuilding(dirname=None):
+    """
+    Returns True while a full rebuild of the index is running.
+    """
+    marker = rebuild_marker(dirname or settings.INDEX_DIR)
+    try:
+        age = time.time() - os.path.getmtime(marker)
+    except OSError:
+        return False
+
+    # The marker of a rebuild that crashed is ignored after a while.
+    return age < settings.INDEX_REBUILD_SECS
+
+
+def prune_generations(target):
+    """
+    Removes the index generations that were retired more than INDEX_RETIRE_SECS ago.
+    """
+    live = os.path.realpath(target)
+    for generation in glob.glob(f"{target}.gen-*"):
+        marker = os.path.join(generation, "RETIRED")
+        if os.path.realpath(generation) == live or not os.path.exists(marker):
+            continue
+        if time.time() - os.path.getmtime(marker) >= settings.INDEX_RETIRE_SECS:
+            shutil.rmtree(generation, ignore_errors=True)
+
+
+def swap_index(source, target):
+    """
+    Replaces the index in target with the one found in source.
+
+    The target is a symbolic link to a generation directory and is replaced
+    with a single atomic rename, searchers always find a complete index.
+    The retired generation is kept until the searchers had time to move on.
+    """
+    generation = f"{target}.gen-{util.get_uuid(8)}"
+    os.rename(source, generation)
+
+    if os.path.islink(target):
+        retired = os.path.realpath(target)
+    elif os.path.isdir(target):
+        # An index from before generations were used becomes the retired generation.
+        retired = f"{target}.gen-{util.get_uuid(8)}"
+        os.rename(target, retired)
+    else:
+        retired = None
+
+    # Build the new link next to the target then rename it over the target.
+    link = f"{target}.link-{util.get_uuid(8)}"
+    os.symlink(os.path.basename(generation), link)
+    try:
+        os.replace(link, target)
+    except OSError:
+        # A searcher recreated an empty index after the old directory was moved.
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(link, target)
+
+    # Retired files are removed on a later swap, open readers keep working until then.
+    if retired and os.path.isdir(retired):
+        open(os.path.join(retired, "RETIRED"), "w").close()
+
+    prune_generations(target)
+
+
+def rebuild_index(workers=4, dirname=None, indexname=None):
+    """
+    Rebuilds the full index with a process pool, each process indexes one id range.
+
+    The partitions are merged into a fresh index that is swapped into place,
+    the existing index keeps serving searches until the swap.
+    Returns the number of posts indexed.
+    """
+    dirname = dirname or settings.INDEX_DIR
+    indexname = indexname or settings.INDEX_NAME
+
+    elapsed, progress = timer_func()
+
+    bounds = Post.objects.aggregate(lo=Min("id"), hi=Max("id"))
+    lo, hi = bounds['lo'] or 0, bounds['hi'] or 0
+    step = math.ceil((hi - lo + 1) / workers)
+
+    build_dir = f"{dirname}.build-{util.get_uuid(8)}"
+    parts = [(os.path.join(build_dir, f"part-{i}"), indexname, lo + i * step, lo + (i + 1) * step)
+             for i in range(workers)]
+
+    # The queue is not drained while building, edits made from here on
+    # stay queued and are indexed into the new index after the swap.
+    marker = rebuild_marker(dirname)
+    open(marker, "w").close()
+    queued = Post.objects.filter(indexed=False).exclude(root=None)
+    queued = list(queued.values_list("id", flat=True))
+    Post.objects.filter(indexed=False).exclude(root=None).update(indexed=True)
+
+    # Forked processes must open their own database connections.
+    connections.close_all()
+
+    try:
+        with multiprocessing.Pool(processes=workers) as pool:
+            results = pool.map(build_partition, parts)
+
+        elapsed(f"Built {workers} partitions")
+
+        # Merge the partitions into a fresh index.
+        fresh = os.path.join(build_dir, "merged")
+        ix = init_index(dirname=fresh, indexname=indexname)
+        writer = ix.writer(limitmb=settings.INDEX_LIMIT_MB)
+        for part, _ in results:
+            reader = open_dir(dirname=part, indexname=indexname).reader()
+            writer.add_reader(reader)
+            reader.close()
+        writer.commit()
+
+        elapsed(f"Merged {workers} partitions")
+
+        swap_index(source=fresh, target=dirname)
+
+    except Exception:
+        # The old index stays live, only the posts it is missing go back on the queue.
+        size = settings.BATCH_INDEXING_SIZE
+        for start in range(0, len(queued), size):
+            Post.objects.filter(id__in=queued[start:start + size]).update(indexed=False)
+        raise
+
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.remove(marker)
+
+    total = sum(size for _, size in results)
+    elapsed(f"Indexed posts={total}")
+
+    return total
+
+
+def find_similar(uids, top=None):
+    """
+    Returns a dictionary keyed by uid with the top level posts similar to each post.
+    Posts missing from the index are skipped.
+    """
+    top = top or settings.SIMILAR_FEED_COUNT
+    searcher = get_searcher()
+
+    found = dict()
+    for uid in uids:
+        docnum = searcher.document_number(uid=uid)
+        if docnum is None:
+            continue
+
+        hits = searcher.more_like(docnum, "content", top=top)
+        found[uid] = [dict(uid=hit['uid'], title=hit['title'], url=hit['url'], content=hit['content'][:200])
+                      for hit in hits if hit['is_toplevel'] is True]
+
+    return found
+
+
+def store_similar(posts, found):
+    """
+    Stores the similar posts found for each uid, posts maps uids to ids.
+    Returns the number of posts updated.
+    """
+    now = util.now()
+    ids = [posts[uid] for uid in found]
+    rows = [SimilarPosts(post_id=posts[uid], data=json.dumps(items), date=now) for uid, items in found.items()]
+
+    # Replace the previously computed rows.
+    SimilarPosts.objects.filter(post_id__in=ids).delete()
+    SimilarPosts.objects.bulk_create(rows)
+
+    return len(rows)
+
+
+def update_similar(ids, top=None):
+    """
+    Computes and stores the similar posts for the top level posts in ids.
+    Returns the number of posts updated.
+    """
+    posts = dict(Post.objects.filter(id__in=ids, is_toplevel=True).values_list("uid", "id"))
+    found = find_similar(uids=posts.keys(), top=top)
+
+    return store_similar(posts=posts, found=found)
+
+
+def similar_partition(ids):
+    """
+    Computes the similar posts for a partition of ids in a separate process.
+    """
+    # Database connections and open searchers may not be shared with the parent process.
+    connections.close_all()
+    SEARCHERS.reset()
+
+    posts = dict(Post.objects.filter(id__in=ids).values_list("uid", "id"))
+    found = find_similar(uids=posts.keys())
+
+    return posts, found
+
+
+def rebuild_similar(workers=4, size=1000):
+    """
+    Recomputes the similar posts for all top level posts with a process pool.
+    The searches run in parallel, the results are stored by the calling process.
+    Returns the number of posts updated.
+    """
+    elapsed, progress = timer_func()
+
+    ids = Post.objects.valid_posts(is_toplevel=True).exclude(spam=Post.SPAM).order_by("id")
+    ids = list(ids.values_list("id", flat=True))
+    parts = [ids[i:i + size] for i in range(0, len(ids), size)]
+
+    # Forked processes must open their own database connections.
+    connections.close_all()
+
+    total = 0
+    with multiprocessing.Pool(processes=workers) as pool:
+        for posts, found in pool.imap_unordered(similar_partition, parts):
+            total += store_similar(posts=posts, found=found)
+            progress(total, step=size, total=len(ids), msg="similar posts computed")
+
+    elapsed(f"Computed similar posts={total}")
+
+    return total
+
+
+def remove_post(uid):
+    """
+    Removes a post from the search index.
+    """
+    ix = init_index()
+    writer = AsyncWriter(ix)
+    writer.delete_by_term('uid', uid)
+    writer.commit()
+
+
 def crawl(reindex=False, overwrite=False, limit=1000):
     """
     Crawl through posts in batches and add them to index.
@@ -253,18 +799,11 @@ def crawl(reindex=False, overwrite=False, limit=1000):
         logger.info(f"Setting indexed field to false on all post.")
         Post.objects.filter(indexed=True).exclude(root=None).update(indexed=False)
 
-    # Index a limited number of posts at one time.
-    posts = Post.objects.valid_posts().exclude(Q(spam=Post.SPAM) | Q(indexed=False))[:limit]
-
     try:
-        # Add post to search index.
-        index_posts(posts=posts, overwrite=overwrite)
+        # Add a limited number of queued posts to search index.
+        update_index(limit=limit, overwrite=overwrite)
     except Exception as exc:
         logger.error(f'Error updating index: {exc}')
-        Post.objects.filter(id__in=posts.values('id')).update(indexed=False)
-
-    # Set the indexed field to true
-    Post.objects.filter(id__in=posts.values('id')).update(indexed=True)
 
     return
 
@@ -273,18 +812,20 @@ def preform_whoosh_search(query, ix=None, fields=None, page=None, per_page=None,
     """
         Query the indexed, looking for a match in the specified fields.
         Results a tuple of results and an open searcher object.
+
+        Searchers for the default index come from the pool and must not be closed,
+        searchers opened on a given index should be closed by the caller.
         """
 
     per_page = per_page or settings.SEARCH_RESULTS_PER_PAGE
     fields = fields or ['tags', 'title', 'author', 'author_uid', 'author_handle']
-    ix = ix or init_index()
-    searcher = ix.searcher()
+    searcher = ix.searcher() if ix else get_searcher()
 
     # Splits the query into words and applies
     # and OR filter, eg. 'foo bar' == 'foo OR bar'
     orgroup = OrGroup
 
-    parser = MultifieldParser(fieldnames=fields, schema=ix.schema, group=orgroup).parse(query)
+    parser = MultifieldParser(fieldnames=fields, schema=searcher.schema, group=orgroup).parse(query)
     if page:
         # Return a pagenated version of the results.
         results = searcher.search_page(parser,
@@ -306,6 +847,92 @@ def preform_whoosh_search(query, ix=None, fields=None, page=None, per_page=None,
     return results
 
 
+def normalize_search(query, **kwargs):
+    """
+    Returns a digest and a readable form of a search, equivalent searches have the same digest.
+    """
+    # Operators and ID fields are case sensitive, only whitespace is normalized.
+    query = " ".join(query.split())
+    fields = sorted(kwargs.pop('fields', None) or [])
+    params = sorted(kwargs.items())
+    text = f"{query} fields={','.join(fields)} {params}"
+    digest = hashlib.md5(text.encode("utf-8")).hexdigest()
+
+    return digest, text
+
+
+def count_access(digest, text, hit):
+    """
+    Increments the hit or miss counter of a cache entry.
+    """
+    name = "hits" if hit else "misses"
+    key = f"{const.SEARCH_STATS_KEY}-{name}-{digest}"
+    if not cache.add(key, 1, timeout=None):
+        cache.incr(key)
+
+    if hit:
+        return
+
+    # Keep track of the searches that are counted.
+    registry = cache.get(const.SEARCH_STATS_KEY, {})
+    if digest not in registry and len(registry) < settings.SEARCH_STATS_LIMIT:
+        registry[digest] = text
+        cache.set(const.SEARCH_STATS_KEY, registry, timeout=None)
+
+
+def cache_stats():
+    """
+    Returns the text, hits and misses for counted searches, most hit first.
+    """
+    registry = cache.get(const.SEARCH_STATS_KEY, {})
+    keys = [f"{const.SEARCH_STATS_KEY}-{name}-{digest}" for digest in registry for name in ("hits", "misses")]
+    counts = cache.get_many(keys)
+
+    stats = []
+    for digest, text in registry.items():
+        hits = counts.get(f"{const.SEARCH_STATS_KEY}-hits-{digest}", 0)
+        misses = counts.get(f"{const.SEARCH_STATS_KEY}-misses-{digest}", 0)
+        stats.append((text, hits, misses))
+
+    stats.sort(key=lambda x: x[1], reverse=True)
+
+    return stats
+
+
+def cached_search(func, query, **kwargs):
+    """
+    Returns the results of func(query, **kwargs) from the cache.
+
+    Cache keys are tagged with the index version, a commit
+    or a rebuild of the index invalidates all previous entries.
+    """
+    digest, text = normalize_search(query, **kwargs)
+    version = SEARCHERS.version()
+    key = f"{const.SEARCH_CACHE_KEY}-{version}-{digest}"
+
+    results = cache.get(key)
+    count_access(digest=digest, text=text, hit=results is not None)
+
+    if results is None:
+        results = func(query=query, **kwargs)
+        cache.set(key, results, settings.SEARCH_CACHE_SECS)
+
+    return results
+
+
+def search_page(query, page=1, fields=None, sortedby=[]):
+    """
+    Returns a cached page of search results.
+    """
+
+    def run(query, **kwargs):
+        results = preform_whoosh_search(query=query, **kwargs)
+        hits = [hit.fields() for hit in results]
+        return SearchPage(hits=hits, total=results.total, pagenum=results.pagenum, pagecount=results.pagecount)
+
+    return cached_search(run, query=query, page=page, fields=fields, sortedby=sortedby)
+
+
 def preform_search(query, fields=None, top=0, sortedby=[], more_like_this=False):
 
     top = top or settings.SIMILAR_FEED_COUNT
@@ -314,6 +941,15 @@ def preform_search(query, fields=None, top=0, sortedby=[], more_like_this=False)
     if length < settings.SEARCH_CHAR_MIN:
         return []
     fields = fields or ['tags', 'title', 'author', 'author_uid', 'author_handle']
+
+    results = cached_search(uncached_search, query=query, fields=fields, top=top, sortedby=sortedby,
+                            more_like_this=more_like_this)
+
+    return results
+
+
+def uncached_search(query, fields, top, sortedby=[], more_like_this=False):
+
     whoosh_results = preform_whoosh_search(query=query, sortedby=sortedby, fields=fields)
 
     if more_like_this and len(whoosh_results):
@@ -325,10 +961,5 @@ def preform_search(query, fields=None, top=0, sortedby=[], more_like_this=False)
 
     # Ensure returned results types stay consistent.
     final_results = list(map(normalize_result, results))
-    if not len(final_results):
-        return []
-
-    # Ensure searcher object gets closed.
-    whoosh_results.searcher.close()
 
     return final_results
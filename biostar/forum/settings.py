@@ -60,6 +60,15 @@ SPAM_INDEX_DIR = os.path.abspath(os.path.join(MEDIA_ROOT, '..', SPAM_INDEX_DIR))
 # Classify posts and assign a spam score on creation.
 CLASSIFY_SPAM = True
 
+# Naive Bayes spam model stored as numpy arrays in export/
+SPAM_MODEL_FILE = os.path.abspath(os.path.join(MEDIA_ROOT, '..', 'spam_model.npz'))
+
+# Number of hashed word features used by the spam model.
+SPAM_MODEL_FEATURES = 2 ** 18
+
+# Probability above which the spam model predicts spam.
+SPAM_MODEL_THRESHOLD = .5
+
 ENABLE_DIGESTS = False
 
 # Disable all asynchronous tasks
@@ -71,6 +80,9 @@ TIME_REQUESTS = True
 # Indexing interval in seconds.
 INDEX_SECS_INTERVAL = 10
 
+# Interval in seconds between creating the awards of recently active users.
+AWARDS_SECS_INTERVAL = 60 * 5
+
 # Number of results to display in total.
 SEARCH_LIMIT = 20
 
@@ -82,8 +94,20 @@ SEARCH_CHAR_MIN = 1
 # Number of results to display per page.
 SEARCH_RESULTS_PER_PAGE = 50
 
+# Time to live in seconds for cached search results.
+SEARCH_CACHE_SECS = 3600
+
+# Maximum number of searches with hit and miss counters.
+SEARCH_STATS_LIMIT = 1000
+
 BATCH_INDEXING_SIZE = 1000
 
+# Memory limit in megabytes for each index writer during a full rebuild.
+INDEX_LIMIT_MB = 256
+
+# Seconds the index queue waits for the index write lock before the posts are queued again.
+INDEX_WRITER_SECS = 30
+
 # Add another context processor to first template.
 TEMPLATES[0]['OPTIONS']['context_processors'] += [
     'biostar.forum.context.forum'
@@ -105,6 +129,12 @@ INDEX_DIR = os.environ.setdefault("INDEX_DIR", "search")
 # Absolute path to index directory in export/
 INDEX_DIR = os.path.abspath(os.path.join(MEDIA_ROOT, '..', INDEX_DIR))
 
+# Seconds a replaced index is kept on disk for searchers that still have it open.
+INDEX_RETIRE_SECS = 60 * 60
+
+# Seconds after which the marker of a full rebuild that never finished is ignored.
+INDEX_REBUILD_SECS = 60 * 60 * 6
+
 SOCIALACCOUNT_EMAIL_VERIFICATION = None
 SOCIALACCOUNT_EMAIL_REQUIRED = False
 SOCIALACCOUNT_QUERY_EMAIL = True
@@ -154,9 +184,57 @@ ROOT_URLCONF = 'biostar.forum.urls'
 
 WSGI_APPLICATION = 'biostar.wsgi.application'
 
+# Seconds the html rendered from a markdown text stays in the cache.
+MARKDOWN_CACHE_SECS = 60 * 60 * 24
+
+# Function called with a link that returns the html to embed in its place.
+EMBED_FETCHER = "biostar.forum.markdown.fetch_embed"
+
+# Seconds before an embedded html is fetched again.
+EMBED_CACHE_SECS = 60 * 60 * 24 * 7
+
+# Seconds to wait for a response when fetching an embed.
+EMBED_TIMEOUT = 5
+
+# Seconds a worker holds a database task before another worker may take it over.
+TASK_LEASE_SECS = 60 * 10
+
+# Attempts at running a database task before it is marked as failed.
+TASK_MAX_ATTEMPTS = 3
+
+# Seconds before a failed task is retried, doubled after each attempt.
+TASK_RETRY_SECS = 60
+
+# Seconds an idle worker waits before looking for new tasks.
+TASK_POLL_SECS = 2
+
+# Number of pages of each post listing cached for anonymous users.
+LISTING_CACHE_PAGES = 5
+
+# Seconds the post ids of a listing stay cached, rank changes invalidate them earlier.
+LISTING_CACHE_SECS = 300
+
+# Seconds a rendered thread is served from the cache to anonymous users.
+THREAD_CACHE_SECS = 300
+
+# Seconds between rebuilds of the username autocomplete index.
+USER_INDEX_SECS = 3600
+
+# Number of usernames returned by the autocomplete.
+USER_AUTOCOMPLETE_LIMIT = 10
+
 # Time between two accesses from the same IP to qualify as a different view.
 POST_VIEW_MINUTES = 7
 
+# Seconds that counted views are buffered before being written to the database.
+POST_VIEW_FLUSH_SECS = 30
+
+# Number of buffered views that triggers a write to the database.
+POST_VIEW_BUFFER_SIZE = 500
+
+# Store each counted view in the PostView table, used for the traffic stats.
+POST_VIEW_RECORD = True
+
 COUNT_INTERVAL_WEEKS = 10000
 
 # This flag is used flag situation where a data migration is in progress.
@@ -1,11 +1,12 @@
 import logging
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from taggit.models import Tag
 from django.db.models import F, Q
 from biostar.accounts.models import Profile, Message, User
 from biostar.forum.models import Post, Award, Subscription
-from biostar.forum import tasks, auth, util, spam
+from biostar.forum import tasks, auth, util, spam, markdown
 
 
 logger = logging.getLogger("biostar")
@@ -25,6 +26,49 @@ def send_award_message(sender, instance, created, **kwargs):
     return
 
 
+@receiver(post_save, sender=Profile)
+def index_username(sender, instance, created, **kwargs):
+    """
+    Add new users to the username autocomplete index.
+    """
+    if created:
+        # The username is finalized right before the profile is created.
+        username = User.objects.filter(pk=instance.user_id).values_list('username', flat=True).first()
+        auth.index_user(pk=instance.user_id, username=username)
+
+
+@receiver(pre_save, sender=User)
+def rename_user(sender, instance, update_fields=None, **kwargs):
+    """
+    Html that mentions the old handle of a renamed user is rendered again.
+    """
+    if not instance.pk or (update_fields and "username" not in update_fields):
+        return
+
+    username = User.objects.filter(pk=instance.pk).values_list("username", flat=True).first()
+    if username and username != instance.username:
+        markdown.bump_refs("user", username)
+
+
+@receiver(post_save, sender=User)
+def mention_user(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Html that mentions the handle of a new or renamed user is rendered again.
+    """
+    if created or not update_fields or "username" in update_fields:
+        markdown.bump_refs("user", instance.username)
+
+
+@receiver(post_save, sender=Profile)
+def rename_profile(sender, instance, created, **kwargs):
+    """
+    Html that links to the profile or mentions the user shows the current name.
+    """
+    username = User.objects.filter(pk=instance.user_id).values_list("username", flat=True).first()
+    markdown.bump_refs("user", username)
+    markdown.bump_refs("profile", instance.uid)
+
+
 @receiver(post_save, sender=Profile)
 def ban_user(sender, instance, created, **kwargs):
     """
@@ -55,78 +99,83 @@ def ban_user(sender, instance, created, **kwargs):
 @receiver(post_save, sender=Post)
 def finalize_post(sender, instance, created, **kwargs):
 
-    # Determine the root of the post.
-    root = instance.root if instance.root is not None else instance
-
-    # Update last contributor, last editor, and last edit date to the thread
-    Post.objects.filter(uid=root.uid).update(lastedit_user=instance.lastedit_user,
-                                             last_contributor=instance.last_contributor,
-                                             lastedit_date=instance.lastedit_date)
-
-    # Get newly created subscriptions since the last edit date.
-    subs = Subscription.objects.filter(date__gte=instance.lastedit_date, post=instance.root)
-
     if created:
-        # Make the Uid user friendly
-        instance.uid = instance.uid or f"p{instance.pk}"
-
-        if instance.parent:
-            # When the parent is set the root must follow the parent root.
-            instance.root = instance.parent.root
-        else:
-            # When there is no parent, root and parent are set to itself.
+        # Top level posts are their own root and parent.
+        if instance.parent is None:
             instance.root = instance.parent = instance
 
-        # Answers and comments may only have comments associated with them.
-        if instance.parent.type in (Post.ANSWER, Post.COMMENT):
-            instance.type = Post.COMMENT
+        # Make the Uid user friendly
+        if getattr(instance, "uid_from_pk", False):
+            instance.uid = f"p{instance.pk}"
 
         # Sanity check.
         assert instance.root and instance.parent
 
+        # Fields that depend on the primary key.
+        Post.objects.filter(pk=instance.pk).update(uid=instance.uid, root=instance.root, parent=instance.parent)
+
         if instance.is_toplevel:
             # Add tags for top level posts.
             tags = [Tag.objects.get_or_create(name=name)[0] for name in instance.parse_tags()]
-            instance.tags.remove()
             instance.tags.add(*tags)
         else:
-            # Title is inherited from top level.
-            instance.title = "%s: %s" % (instance.get_type_display(), instance.root.title[:80])
+            # Make the last editor first in the list of contributors
+            # Done on post creation to avoid moderators being added for editing a post.
+            instance.root.thread_users.remove(instance.lastedit_user)
 
-        # Make the last editor first in the list of contributors
-        # Done on post creation to avoid moderators being added for editing a post.
-        instance.root.thread_users.remove(instance.lastedit_user)
         instance.root.thread_users.add(instance.lastedit_user)
 
-        # Update this post rank on create and not every edit.
-        instance.rank = instance.lastedit_date.timestamp()
-
-        # Save the instance.
-        instance.save()
-        instance.update_parent_counts()
-
-        # Bump the root rank when a new descendant is added.
-        Post.objects.filter(uid=instance.root.uid).update(rank=util.now().timestamp())
-
         # Create subscription to the root.
         auth.create_subscription(post=instance.root, user=instance.author)
 
+        # Update the thread counts, the last editor and bump the root rank in one statement.
+        instance.update_parent_counts(lastedit_user=instance.lastedit_user,
+                                      last_contributor=instance.last_contributor,
+                                      lastedit_date=instance.lastedit_date,
+                                      rank=util.now().timestamp())
+
         # Get all subscribed users when a new post is created
         subs = Subscription.objects.filter(post=instance.root)
 
         # Notify users who are watching tags in this post
         #tasks.notify_watched_tags(post=instance)
 
-        # Give it a spam score.
-        tasks.spam_scoring.spool(post=instance)
+        # Give it a spam score once the post is committed.
+        transaction.on_commit(lambda: tasks.spam_scoring.spool(post_id=instance.id))
+    else:
+        # Update last contributor, last editor, and last edit date to the thread
+        Post.objects.filter(pk=instance.root_id).update(lastedit_user=instance.lastedit_user,
+                                                        last_contributor=instance.last_contributor,
+                                                        lastedit_date=instance.lastedit_date)
+
+        # Get newly created subscriptions since the last edit date.
+        subs = Subscription.objects.filter(date__gte=instance.lastedit_date, post=instance.root)
+
+        # Ensure posts get re-indexed after being edited.
+        Post.objects.filter(pk=instance.pk).update(indexed=False)
+
+        # Html that links to this post shows the current title.
+        markdown.bump_refs("post", instance.uid)
 
-    # Add this post to the spam index if it's spam.
-    tasks.update_spam_index.spool(post=instance)
+        # Status and spam of a root apply to the whole thread.
+        if instance.is_toplevel:
+            Post.objects.update_visibility(root_id=instance.root_id)
+        else:
+            Post.objects.update_visibility(id=instance.id)
+
+    # Add this post to the spam index if it's spam, once the post is committed.
+    transaction.on_commit(lambda: tasks.update_spam_index.spool(post_id=instance.id))
 
-    # Ensure posts get re-indexed after being edited.
-    Post.objects.filter(uid=instance.uid).update(indexed=False)
+    # Rendered copies of the thread are out of date, ranks and edit dates of the listings changed.
+    auth.bump_thread(root_id=instance.root_id, listings=True)
+
+    # Embedded links are fetched after the post is committed.
+    if markdown.TWITTER_PATTERN.search(instance.content or ""):
+        transaction.on_commit(lambda: tasks.fetch_embeds.spool(uid=instance.uid))
 
     # Exclude current authors from receiving messages from themselves
     subs = subs.exclude(Q(type=Subscription.NO_MESSAGES) | Q(user=instance.author))
-    extra_context = dict(post=instance)
-    tasks.notify_followers.spool(subs=subs, author=instance.author, extra_context=extra_context)
+
+    # Tasks running in other processes only see committed posts.
+    transaction.on_commit(lambda: tasks.notify_followers.spool(sub_ids=list(subs.values_list("id", flat=True)),
+                                                               author_id=instance.author_id, post_id=instance.id))
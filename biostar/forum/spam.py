@@ -11,6 +11,9 @@ from whoosh.writing import AsyncWriter, BufferedWriter
 from whoosh import classify
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.fields import ID, TEXT, KEYWORD, Schema, NUMERIC, BOOLEAN
+from whoosh.filedb.filestore import RamStorage
+from whoosh.reading import MultiReader
+from whoosh.searching import Searcher
 from biostar.forum.models import Post
 from biostar.forum import search, auth, util
 
@@ -91,9 +94,11 @@ def add_spam(post):
     return
 
 
-def build_spam_index(overwrite=False, add_ham=False, limit=500):
+def training_ids(limit=500, add_ham=False):
+    """
+    Returns the ids of the spam and ham posts used for training.
+    """
     # Get all un-indexed spam posts.
-
     spam = Post.objects.filter(spam=Post.SPAM).exclude(spam=Post.SUSPECT)
     spam = spam.order_by("pk")[:limit]
     spam = list(spam.values_list("id", flat=True))
@@ -105,6 +110,13 @@ def build_spam_index(overwrite=False, add_ham=False, limit=500):
     else:
         ham = []
 
+    return spam, ham
+
+
+def build_spam_index(overwrite=False, add_ham=False, limit=500):
+
+    spam, ham = training_ids(limit=limit, add_ham=add_ham)
+
     posts = Post.objects.filter(id__in=chain(spam, ham))
 
     # Initialize the spam index
@@ -117,39 +129,60 @@ def build_spam_index(overwrite=False, add_ham=False, limit=500):
     return ix
 
 
-def search_spam(post, ix,):
+def get_spam_searcher():
     """
-    Search spam index for posts similar to this one.
-    Returns
+    Returns the pooled searcher of the spam index.
     """
-    writer = AsyncWriter(ix)
+    return search.get_searcher(dirname=settings.SPAM_INDEX_DIR,
+                               indexname=settings.SPAM_INDEX_NAME,
+                               schema=spam_schema())
+
+
+def similar_spam(searcher, post, top=5, numterms=5):
+    """
+    Returns the documents similar to the post content without adding the post to the index.
+
+    The post is indexed in memory and read together with the spam index, the key terms
+    and scores are the same as with Hit.more_like_this('content') on the post added to the index.
+    """
+    # A single document index holding the post.
+    extra = RamStorage().create_index(searcher.schema)
+    writer = extra.writer()
     add_post_to_index(post=post, writer=writer, is_spam=post.is_spam)
     writer.commit()
+    extra = extra.reader()
 
-    # Search for this post in the spam index
-    fields = ['uid']
+    try:
+        # The segments of the spam index followed by the post.
+        leaves = [leaf for leaf, offset in searcher.reader().leaf_readers()]
+        docnum = sum(leaf.doc_count_all() for leaf in leaves)
+        combined = Searcher(MultiReader(leaves + [extra]), weighting=searcher.weighting)
 
-    results = search.preform_whoosh_search(ix=ix, query=post.uid, fields=fields)
+        # The searcher is not closed, the spam index readers belong to the pooled searcher.
+        results = combined.more_like(docnum, "content", top=top, numterms=numterms, model=classify.Bo1Model)
+        results = list(map(search.normalize_result, results))
+    finally:
+        extra.close()
 
-    # Preform more_like_this on this posts content
-    similar_content = results[0].more_like_this('content', top=5)
+    return results
 
-    # Remove this post from the spam index after results are collected.
-    writer = AsyncWriter(ix)
-    writer.delete_by_term('uid', text=post.uid)
-    writer.commit()
 
-    # Get the results into a list and close the searcher object.
-    similar_content = list(map(search.normalize_result, similar_content))
+def search_spam(post, ix=None):
+    """
+    Search spam index for posts similar to this one.
+    The index is only read, a cached searcher is used when no index is given.
+    """
+    if ix is None:
+        return similar_spam(searcher=get_spam_searcher(), post=post)
 
-    results.searcher.close()
+    with ix.searcher() as searcher:
+        similar_content = similar_spam(searcher=searcher, post=post)
 
     return similar_content
 
 
 def compute_score(post, ix=None):
 
-    ix = ix or init_spam_index()
     N = 1
     weight = .7
     bias = -0.25
@@ -366,5 +399,7 @@ def score(post, threshold=None):
 
     # If the score exceeds threshold it gets quarantined.
     if post_score >= threshold:
-        Post.objects.filter(id=post.id).update(spam=Post.SUSPECT)
+        Post.objects.filter(id=post.id).update(spam=Post.SUSPECT, indexed=False)
+        Post.objects.update_visibility(root_id=post.root_id)
+        auth.bump_thread(root_id=post.root_id, listings=True)
         auth.log_action(log_text=f"Quarantined post={post.uid}; spam score={post_score}")
@@ -32,17 +32,22 @@ function move_post(parent_elem, source_elem) {
 }
 
 
-function autocomplete_users(users_list) {
+function autocomplete_users() {
     // Add autocomplete to any text area element with autocomplete tag.
     var autocomplete = $('.autocomplete');
 
-    // Map values in list to a list of dict [{key:'chosen', name:'displayed name'}....]
-    var vals = $.map(users_list, function (value) {
-        return {
-            key: value,
-            name: value
-        };
-    });
+    // Fetch the usernames starting with the typed prefix.
+    function find_users(query, callback) {
+        $.getJSON('/ajax/users/', {prefix: query}, function (data) {
+            // Map values in list to a list of dict [{key:'chosen', name:'displayed name'}....]
+            callback($.map(data.users || [], function (value) {
+                return {
+                    key: value,
+                    name: value
+                };
+            }));
+        });
+    }
 
     function img_url(username) {
         let url = '/ajax/user/image/{0}/'.format(username);
@@ -54,10 +59,14 @@ function autocomplete_users(users_list) {
     var AutocompleteSettings = {
         // Gets triggered at @
         at: "@",
-        data: vals,
+        data: [],
+        minLen: 1,
         displayTpl: img_url('${key}'),
         insertTpl: '@${key}',
-        delay: 40
+        delay: 40,
+        callbacks: {
+            remoteFilter: find_users
+        }
     };
 
     autocomplete.atwho(AutocompleteSettings);
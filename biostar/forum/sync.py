@@ -472,6 +472,9 @@ def sync_posts(threads, users, update=True):
                              fields=["reply_count", "comment_count", "answer_count"],
                              batch_size=1000)
 
+    # Hide the synced posts that are closed or spam.
+    Post.objects.update_visibility()
+
 
 @timer
 def sync_users(users):
@@ -2,8 +2,9 @@
 from biostar.accounts.tasks import create_messages
 from biostar.emailer.tasks import send_email
 import time
-from biostar.utils.decorators import spool, timer
+from biostar.utils.decorators import spool, timer, task_options
 from django.db.models import Q
+from django.conf import settings
 #
 # Do not use logging in tasks! Deadlocking may occur!
 #
@@ -14,41 +15,62 @@ def message(msg, level=0):
     print(f"{msg}")
 
 
+def failed(exc):
+    """
+    Reports the error of a spooled task, tasks run from the database queue raise it to be retried.
+    """
+    from biostar.forum import queue
+
+    message(exc)
+    if queue.is_running():
+        raise exc
+
+
 @spool(pass_arguments=True)
-def spam_scoring(post):
+@task_options(priority=10, key=lambda post_id: f"spam_scoring-{post_id}")
+def spam_scoring(post_id):
     """
     Score the spam with a slight delay.
     """
     from biostar.forum import spam
+    from biostar.forum.models import Post
 
     # Give spammers the illusion of success with a slight delay
     time.sleep(1)
 
+    post = Post.objects.filter(id=post_id).first()
+    if not post:
+        return
+
     try:
         # Give this post a spam score and quarantine it if necessary.
         spam.score(post=post)
     except Exception as exc:
-        message(exc)
+        failed(exc)
 
 
 @spool(pass_arguments=True)
-def update_spam_index(post):
+@task_options(key=lambda post_id: f"update_spam_index-{post_id}")
+def update_spam_index(post_id):
     """
     Update spam index with this post.
     """
     from biostar.forum import spam
+    from biostar.forum.models import Post
+
+    post = Post.objects.filter(id=post_id).first()
 
     # Index posts explicitly marked as SPAM or NOT_SPAM
     # indexing SPAM increases true positives.
     # indexing NOT_SPAM decreases false positives.
-    if not (post.is_spam or post.not_spam):
+    if not post or not (post.is_spam or post.not_spam):
         return
 
     # Update the spam index with most recent spam posts
     try:
         spam.add_spam(post=post)
     except Exception as exc:
-        message(exc)
+        failed(exc)
 
 
 @spool(pass_arguments=True)
@@ -57,81 +79,131 @@ def created_post(pid):
     pass
 
 
-#
-# This timer leads to problems as described in
-#
-# https://github.com/unbit/uwsgi/issues/1369
-#
+@timer(secs=settings.INDEX_SECS_INTERVAL)
+def update_index(*args):
+    """
+    Drains the queue of edited posts into the search index.
+    """
+    from biostar.forum import search
+
+    # Logging from timers may deadlock, see https://github.com/unbit/uwsgi/issues/1369
+    try:
+        total = search.update_index()
+        if total:
+            message(f"Updated search index with {total} posts.")
+    except Exception as exc:
+        message(f'Error updating index: {exc}')
+
+
+@timer(secs=max(settings.POST_VIEW_FLUSH_SECS, 1), target="workers")
+def flush_post_views(*args):
+    """
+    Writes the post views buffered by each web process.
+    """
+    from biostar.forum import auth
+
+    # Every worker keeps its own buffer, the timer runs in all of them.
+    try:
+        auth.flush_views()
+    except Exception as exc:
+        message(f'Error saving post views: {exc}')
+
+
+@timer(secs=settings.USER_INDEX_SECS, target="workers")
+def rebuild_user_index(*args):
+    """
+    Rebuilds the username autocomplete index kept by each web process.
+    """
+    from biostar.forum import auth
+
+    try:
+        auth.refresh_user_index()
+    except Exception as exc:
+        message(f'Error rebuilding the user index: {exc}')
 
-# #@timer(secs=180)
-# def update_index(*args):
-#     """
-#     Index 1000 posts every 3 minutes
-#     """
-#     from biostar.forum.models import Post
-#     from biostar.forum import search
-#     from django.conf import settings
-#
-#     # Get un-indexed posts
-#     posts = Post.objects.filter(indexed=False)[:settings.BATCH_INDEXING_SIZE]
-#
-#     # Nothing to be done.
-#     if not posts:
-#         message("No new posts found")
-#         return
-#
-#     message(f"Indexing {len(posts)} posts.")
-#
-#     # Update indexed field on posts.
-#     Post.objects.filter(id__in=posts.values('id')).update(indexed=True)
-#
-#     try:
-#         search.index_posts(posts=posts)
-#         message(f"Updated search index with {len(posts)} posts.")
-#     except Exception as exc:
-#         message(f'Error updating index: {exc}')
-#         Post.objects.filter(id__in=posts.values('id')).update(indexed=False)
-#
-#     return
 
 @spool(pass_arguments=True)
-def create_user_awards(user_id):
+@task_options(key=lambda uid: f"fetch_embeds-{uid}")
+def fetch_embeds(uid):
+    """
+    Fetch the embedded links of a post and render it again with them.
+    """
+    from biostar.forum import markdown, auth
+    from biostar.forum.models import Post
 
-    from biostar.accounts.models import User
-    from biostar.forum.models import Award, Badge, Post
-    from biostar.forum.awards import ALL_AWARDS
+    try:
+        post = Post.objects.filter(uid=uid).first()
+        if not post or not markdown.fetch_embeds(post.content):
+            return
+        html = markdown.parse(post.content, clean=True, escape=False)
+        Post.objects.filter(uid=uid).update(html=html)
+        auth.bump_thread(root_id=post.root_id)
+    except Exception as exc:
+        failed(exc)
+
+
+@spool(pass_arguments=True)
+@task_options(key=lambda uid: f"remove_from_index-{uid}")
+def remove_from_index(uid):
+    """
+    Remove a deleted post from the search index.
+    """
+    from biostar.forum import search
 
-    user = User.objects.filter(id=user_id).first()
+    try:
+        search.remove_post(uid=uid)
+    except Exception as exc:
+        failed(exc)
 
-    # debugging
-    # Award.objects.all().delete()
 
-    for award in ALL_AWARDS:
-        # Valid award targets the user has earned
-        targets = award.validate(user)
+@spool(pass_arguments=True)
+@task_options(priority=-10, key=lambda user_id: f"create_user_awards-{user_id}")
+def create_user_awards(user_id):
+    """
+    Create the awards earned by a single user.
+    """
+    from biostar.accounts.models import User
+    from biostar.forum import awards
 
-        for target in targets:
-            date = user.profile.last_login
-            post = target if isinstance(target, Post) else None
-            badge = Badge.objects.filter(name=award.name).first()
+    try:
+        total = awards.create_awards(User.objects.filter(id=user_id))
+        if total:
+            message(f"Created {total} awards for user={user_id}")
+    except Exception as exc:
+        failed(exc)
 
-            # Do not award a post multiple times.
-            already_awarded = Award.objects.filter(user=user, badge=badge, post=post).exists()
-            if post and already_awarded:
-                continue
 
-            # Create an award for each target.
-            Award.objects.create(user=user, badge=badge, date=date, post=post)
+@timer(secs=settings.AWARDS_SECS_INTERVAL)
+def create_awards(*args):
+    """
+    Create the awards of users that visited the site since the previous run.
+    """
+    from biostar.forum import awards
 
-            message("award %s created for %s" % (badge.name, user.email))
+    try:
+        total = awards.create_recent_awards()
+        if total:
+            message(f"Created {total} awards.")
+    except Exception as exc:
+        message(f'Error creating awards: {exc}')
 
 
 @spool(pass_arguments=True)
-def notify_followers(subs, author, extra_context={}):
+@task_options(priority=5)
+def notify_followers(sub_ids, author_id, post_id):
     """
     Generate notification to users subscribed to a post, excluding author, a message/email.
     """
-    from biostar.forum.models import Subscription
+    from biostar.accounts.models import User
+    from biostar.forum.models import Post, Subscription
+
+    post = Post.objects.filter(id=post_id).first()
+    author = User.objects.filter(id=author_id).first()
+    if not (post and author):
+        return
+
+    subs = Subscription.objects.filter(id__in=sub_ids).select_related("user")
+    extra_context = dict(post=post)
 
     # Template used to send local messages
     local_template = "messages/subscription_message.md"
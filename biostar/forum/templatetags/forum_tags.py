@@ -221,6 +221,14 @@ def pages(context, objs, show_step=True):
     return dict(objs=objs, url=url, show_step=show_step, request=request)
 
 
+@register.inclusion_tag('widgets/cursor_pages.html', takes_context=True)
+def cursor_pages(context, objs):
+    request = context["request"]
+    url = request.path
+
+    return dict(objs=objs, url=url, request=request)
+
+
 @register.simple_tag
 def randparam():
     "Append to URL to bypass server caching of CSS or JS files"
@@ -459,8 +467,7 @@ def post_list(target, request):
 @register.inclusion_tag('widgets/feed_default.html')
 def default_feed(user):
 
-    recent_votes = Vote.objects.filter(post__status=Post.OPEN,
-                                       post__root__status=Post.OPEN).prefetch_related("post")
+    recent_votes = Vote.objects.filter(post__is_visible=True).prefetch_related("post")
     recent_votes = recent_votes.order_by("-pk")[:settings.VOTE_FEED_COUNT]
 
     # Get valid users that have a location set in profile.
@@ -576,6 +583,22 @@ def relative_url(value, field_name, urlencode=None):
     return url
 
 
+@register.simple_tag
+def cursor_url(value, field_name, urlencode=None):
+    """
+    Url to a cursor page, drops the page number and the other cursor.
+    """
+    url = f'?{field_name}={value}'
+    if urlencode:
+        # Exclude the old paging parameters.
+        querystring = urlencode.split('&')
+        filter_func = lambda p: p.split('=')[0] not in ('page', 'after', 'before')
+        encoded_querystring = '&'.join(filter(filter_func, querystring))
+        url = f'{url}&{encoded_querystring}' if encoded_querystring else url
+
+    return url
+
+
 @register.simple_tag
 def get_thread_users(users, post, limit=2):
 
@@ -716,32 +739,44 @@ def render_comments(context, tree, post, template_name='widgets/comment_body.htm
     return mark_safe(text)
 
 
-def traverse_comments(request, post, tree, template_name):
-    "Traverses the tree and generates the page"
-
-    body = template.loader.get_template(template_name)
+def flatten_comments(post, tree):
+    """
+    Walks the tree without recursion and returns the comments below the post in display order.
+    Each comment comes with the number of nesting levels that end after it.
+    """
+    flat = []
     seen = set()
 
-    def traverse(node, collect=[]):
+    # Each level holds a node and an iterator over its children.
+    stack = [(post, iter(tree.get(post.id, [])))]
 
-        cont = {"post": node, 'user': request.user, 'request': request}
-        html = body.render(cont)
-        collect.append(f'<div class="indent" ><div>{html}</div>')
+    while stack:
+        node, children = stack[-1]
+        child = next(children, None)
 
-        for child in tree.get(node.id, []):
-            if child in seen:
-                raise Exception(f"circular tree {child.pk} {child.title}")
-            seen.add(child)
-            traverse(child, collect=collect)
+        # All children seen, the level of the node ends with the last comment rendered.
+        if child is None:
+            stack.pop()
+            if stack:
+                flat[-1][1] += 1
+            continue
 
-        collect.append(f"</div>")
+        if child in seen:
+            raise Exception(f"circular tree {child.pk} {child.title}")
+        seen.add(child)
+
+        flat.append([child, 0])
+        stack.append((child, iter(tree.get(child.id, []))))
+
+    return [(node, mark_safe("</div>" * depth)) for node, depth in flat]
+
+
+def traverse_comments(request, post, tree, template_name):
+    "Traverses the tree and generates the page"
 
-    # this collects the comments for the post
-    collect = ['<div class="comment-list">']
-    for node in tree[post.id]:
-        traverse(node, collect=collect)
-    collect.append("</div>")
-    html = '\n'.join(collect)
+    comments = flatten_comments(post=post, tree=tree)
+    context = dict(comments=comments, template_name=template_name, user=request.user, request=request)
+    html = template.loader.render_to_string('widgets/comment_list.html', context=context)
 
     return html
 
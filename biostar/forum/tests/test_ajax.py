@@ -1,11 +1,14 @@
 import logging
 import json
+from unittest import mock
+from django.core import management
 from django.test import TestCase
 from django.urls import reverse
+from django.db.models import F
 
 from biostar.accounts.models import User, Profile
 
-from biostar.forum import models, views, auth, forms, const, ajax
+from biostar.forum import models, views, auth, forms, const, ajax, tasks
 from biostar.utils.helpers import fake_request
 from biostar.forum.util import get_uuid
 
@@ -54,6 +57,84 @@ class PostTest(TestCase):
         self.preform_votes(post=self.post, user=self.owner)
         self.preform_votes(post=self.post, user=user2)
 
+    def test_vote_counts(self):
+        """Test vote deltas agree with the recount command"""
+        user2 = User.objects.create(username="user", email="user@tested.com", password="tested")
+        answer = models.Post.objects.create(title="answer", author=user2, content="tested foo bar too for",
+                                            type=models.Post.ANSWER, parent=self.post)
+
+        self.preform_votes(post=answer, user=self.owner)
+        self.preform_votes(post=self.post, user=user2)
+
+        fields = ["vote_count", "book_count", "accept_count", "thread_votecount"]
+        before = list(models.Post.objects.order_by("pk").values_list(*fields))
+        scores = list(Profile.objects.order_by("pk").values_list("score", flat=True))
+
+        management.call_command('recount')
+
+        after = list(models.Post.objects.order_by("pk").values_list(*fields))
+        self.assertEqual(before, after, "Vote counts drifted from the votes table.")
+        self.assertEqual(scores, list(Profile.objects.order_by("pk").values_list("score", flat=True)))
+        self.assertEqual(Profile.objects.get(user=user2).score, 3)
+
+        # Score increments not made by votes are kept unless scores are reset.
+        Profile.objects.filter(user=user2).update(score=F('score') + 10)
+        management.call_command('recount')
+        self.assertEqual(Profile.objects.get(user=user2).score, 13)
+
+        management.call_command('recount', scores=True)
+        self.assertEqual(scores, list(Profile.objects.order_by("pk").values_list("score", flat=True)))
+
+    def test_reply_counts(self):
+        """Test reply counts agree with the recount command"""
+        answer = models.Post.objects.create(title="answer", author=self.owner, content="tested foo bar too for",
+                                            type=models.Post.ANSWER, parent=self.post)
+        comment = models.Post.objects.create(title="comment", author=self.owner, content="tested foo bar too for",
+                                             type=models.Post.COMMENT, parent=answer)
+        models.Post.objects.create(title="comment", author=self.owner, content="tested foo bar too for",
+                                   type=models.Post.COMMENT, parent=comment)
+
+        fields = ["reply_count", "answer_count", "comment_count"]
+        root = models.Post.objects.filter(pk=self.post.pk).values_list(*fields).first()
+        self.assertEqual(root, (3, 1, 2))
+        self.assertEqual(models.Post.objects.filter(pk=answer.pk).values_list(*fields).first(), (1, 0, 1))
+
+        before = list(models.Post.objects.order_by("pk").values_list(*fields))
+        models.Post.objects.update(reply_count=0, answer_count=0, comment_count=0)
+
+        management.call_command('recount')
+
+        after = list(models.Post.objects.order_by("pk").values_list(*fields))
+        self.assertEqual(before, after, "Reply counts drifted from the posts table.")
+
+    def test_find_users(self):
+        """Test the username autocomplete ranks prefix matches by score"""
+        first = User.objects.create(first_name="mentioned", email="mentioned@tested.com", password="tested")
+        Profile.objects.filter(user=first).update(score=10)
+        auth.build_user_index()
+
+        # Users that sign up after the index is built are added to it.
+        second = User.objects.create(first_name="Mention", email="mention@tested.com", password="tested")
+        first.refresh_from_db()
+        second.refresh_from_db()
+
+        request = fake_request(url=reverse('find_users'), data={'prefix': 'menT'}, user=self.owner, method="GET")
+        response = ajax.find_users(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['users'], [first.username, second.username])
+
+        # Short prefixes are kept whole, a smaller first limit does not cut later results.
+        self.assertEqual(auth.find_users(prefix="me", limit=1), [first.username])
+        self.assertEqual(auth.find_users(prefix="me", limit=5), [first.username, second.username])
+
+        # Lookups do not rebuild a stale index, the timer does.
+        auth.USER_INDEX['built'] = 1
+        with mock.patch.object(auth, "build_user_index") as build:
+            auth.find_users(prefix="ment")
+            self.assertFalse(build.called, "Index rebuilt inside a request.")
+            tasks.rebuild_user_index()
+            self.assertTrue(build.called, "Index not rebuilt by the timer.")
+
     def test_drag_and_drop(self):
         """
         Test AJAX function used to drag and drop.
@@ -78,6 +159,24 @@ class PostTest(TestCase):
         json_response = ajax.drag_and_drop(request)
         self.process_response(json_response)
 
+    def test_walk_down_thread(self):
+        """
+        Test the descendants of a post are found with one query.
+        """
+        comment1 = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                              type=models.Post.COMMENT, root=self.post, parent=self.post)
+        comment2 = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                              type=models.Post.COMMENT, root=self.post, parent=comment1)
+        comment3 = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                              type=models.Post.COMMENT, root=self.post, parent=comment2)
+
+        with self.assertNumQueries(1):
+            children = auth.walk_down_thread(parent=comment1)
+        self.assertEqual(children, {comment2, comment3})
+
+        # Results do not leak between calls.
+        self.assertEqual(auth.walk_down_thread(parent=comment3), set())
+
     def test_digest(self):
         """
         Test AJAX function that toggles users digest options
@@ -1,7 +1,12 @@
 import logging
 import os
-from django.test import TestCase
+from unittest import mock
+from django.test import TestCase, override_settings
 from django.conf import settings
+from django.core.cache import cache
+from django.core import management
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from biostar.forum import models, markdown
 from biostar.accounts.models import User
 
@@ -10,6 +15,21 @@ logger = logging.getLogger('engine')
 PORT = ':' + settings.HTTP_PORT if settings.HTTP_PORT else ''
 SITE_URL = f"{settings.SITE_DOMAIN}{PORT}"
 
+TWEET_URL = "https://twitter.com/Linux/status/2311234267"
+TWEET_HTML = '<blockquote class="twitter-tweet"><p lang="en" dir="ltr">w00t! 10,000 followers!</p>&mdash; Linux (@Linux) <a href="https://twitter.com/Linux/status/2311234267?ref_src=twsrc%5Etfw">June 24, 2009</a></blockquote><script async src="https://platform.twitter.com/widgets.js" charset="utf-8"></script>'
+
+
+def fetch_tweet(url):
+    """
+    Stands in for the twitter api.
+    """
+    return TWEET_HTML
+
+
+def fetch_error(url):
+    raise ValueError("Embed not reachable")
+
+
 TEST_CASES = [
 
     # Top level Post anchors
@@ -22,7 +42,7 @@ TEST_CASES = [
     (f"{settings.PROTOCOL}://{SITE_URL}/accounts/profile/5", f'<p><a href="{settings.PROTOCOL}://{SITE_URL}/accounts/profile/5">USER: tested2</a></p>'),
 
     # Twitter link
-    ("https://twitter.com/Linux/status/2311234267", '<p><blockquote class="twitter-tweet"><p lang="en" dir="ltr">w00t! 10,000 followers!</p>&mdash; Linux (@Linux) <a href="https://twitter.com/Linux/status/2311234267?ref_src=twsrc%5Etfw">June 24, 2009</a></blockquote><script async src="https://platform.twitter.com/widgets.js" charset="utf-8"></script></p>'),
+    (TWEET_URL, f'<p>{TWEET_HTML}</p>'),
 
     # Youtube link
     ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", '<p><iframe width="420" height="315" src="//www.youtube.com/embed/dQw4w9WgXcQ" frameborder="0" allowfullscreen></iframe></p>'),
@@ -69,6 +89,7 @@ class MarkdownTest(TestCase):
     def setUp(self):
         # Create user
         logger.setLevel(logging.WARNING)
+        cache.clear()
         self.owner = User.objects.create(username="test", email="tested2@tested.com", password="tested")
 
         self.owner.profile.uid = "5"
@@ -84,11 +105,117 @@ class MarkdownTest(TestCase):
 
         pass
 
+    @override_settings(EMBED_FETCHER="biostar.forum.tests.test_markdown.fetch_tweet")
     def test_markdown(self):
 
         for test in TEST_CASES:
             given, expected = test
 
+            # Embeds are fetched ahead of rendering.
+            markdown.fetch_embeds(given)
+
             html = markdown.parse(given, clean=True, escape=False)
             html = html.replace("\n", "")
-            self.assertEqual(html, expected, f"Error with markdown parsing. input={given}, expected={expected}, html={html}")
\ No newline at end of file
+            self.assertEqual(html, expected, f"Error with markdown parsing. input={given}, expected={expected}, html={html}")
+
+    def test_markdown_cache(self):
+        """
+        Test unchanged content is not parsed again and mentions still subscribe users.
+        """
+        username = User.objects.get(pk=self.owner.pk).username
+        text = f"Cached content for @{username}"
+        answer = models.Post(title="Test", author=self.owner, content=text, type=models.Post.ANSWER,
+                             parent=self.post, root=self.post)
+
+        with mock.patch.object(markdown, "render", wraps=markdown.render) as render:
+            first = markdown.parse(text, post=answer, clean=True, escape=False)
+            models.Subscription.objects.filter(post=self.post, user=self.owner).delete()
+            second = markdown.parse(text, post=answer, clean=True, escape=False)
+
+        self.assertEqual(first, second)
+        self.assertEqual(render.call_count, 1, "Unchanged content parsed again.")
+        self.assertTrue(models.Subscription.objects.filter(post=self.post, user=self.owner).exists(),
+                        "Mentioned user not subscribed on a cache hit.")
+
+    def test_markdown_cache_lookups(self):
+        """
+        Test the cached html follows renamed users and retitled posts.
+        """
+        link = f"{settings.PROTOCOL}://{SITE_URL}/p/1/"
+        text = f"Cached content for @test {link}"
+
+        html = markdown.parse(text, clean=True, escape=False)
+        self.assertIn(">tested2</a>", html)
+        self.assertIn(">Test</a>", html)
+
+        # Cached html costs a single query for the versions of the references.
+        with CaptureQueriesContext(connection) as context:
+            markdown.parse(text, clean=True, escape=False)
+        self.assertEqual(len(context.captured_queries), 1, "Cached html looked up its references.")
+
+        # Text without references is served from the cache alone.
+        markdown.parse("Plain text", clean=True, escape=False)
+        with CaptureQueriesContext(connection) as context:
+            markdown.parse("Plain text", clean=True, escape=False)
+        self.assertEqual(len(context.captured_queries), 0)
+
+        self.owner.profile.name = "Renamed"
+        self.owner.profile.save()
+        self.post.title = "Retitled"
+        self.post.save()
+
+        html = markdown.parse(text, clean=True, escape=False)
+        self.assertIn(">Renamed</a>", html, "Cached html shows the old user name.")
+        self.assertIn(">Retitled</a>", html, "Cached html shows the old post title.")
+
+        # Renamed users are no longer linked by their old handle.
+        user = User.objects.get(pk=self.owner.pk)
+        user.username = "removed"
+        user.save()
+        html = markdown.parse(text, clean=True, escape=False)
+        self.assertIn("@test", html)
+
+    def test_rerender(self):
+        """
+        Test the html of all posts is regenerated.
+        """
+        models.Post.objects.filter(pk=self.post.pk).update(html="stale")
+        management.call_command('rerender', workers=2)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.html, markdown.parse(self.post.content, clean=True, escape=False))
+
+    def test_mention_queries(self):
+        """
+        Test mentions and post links are resolved with a fixed number of queries.
+        """
+        users = [User.objects.create(email=f"mention{i}@tested.com", password="tested") for i in range(30)]
+        names = User.objects.filter(pk__in=[user.pk for user in users]).values_list("username", flat=True)
+        link = f"{settings.PROTOCOL}://{SITE_URL}/p/1/"
+        text = " ".join(f"@{name}" for name in names) + f" {link}"
+
+        answer = models.Post(title="Test", author=self.owner, content=text, type=models.Post.ANSWER,
+                             parent=self.post, root=self.post)
+
+        with CaptureQueriesContext(connection) as context:
+            html = markdown.parse(text, post=answer, clean=True, escape=False)
+
+        self.assertLess(len(context.captured_queries), 10, "Too many queries to render mentions.")
+        self.assertIn(f'<a href="{link}">Test</a>', html)
+        subs = models.Subscription.objects.filter(post=self.post, user__in=users)
+        self.assertEqual(subs.count(), len(users), "Mentioned users not subscribed.")
+
+    def test_embed(self):
+        """
+        Test embeds show a placeholder until fetched.
+        """
+        placeholder = markdown.TWITTER_PLACEHOLDER % (TWEET_URL, TWEET_URL)
+
+        with override_settings(EMBED_FETCHER="biostar.forum.tests.test_markdown.fetch_error"):
+            self.assertEqual(markdown.fetch_embeds(TWEET_URL), 0)
+        self.assertIn(placeholder, markdown.parse(TWEET_URL))
+
+        with override_settings(EMBED_FETCHER="biostar.forum.tests.test_markdown.fetch_tweet"):
+            self.assertEqual(markdown.fetch_embeds(TWEET_URL), 1)
+            # Fresh embeds are not fetched again.
+            self.assertEqual(markdown.fetch_embeds(TWEET_URL), 0)
+        self.assertIn(TWEET_HTML, markdown.parse(TWEET_URL))
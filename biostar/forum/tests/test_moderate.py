@@ -90,4 +90,15 @@ class PostTest(TestCase):
                          f"Could not redirect after tested :\nresponse:{response}")
 
 
-
+    def test_visibility(self):
+        "Test closing a thread hides all of its posts."
+        answer = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                            type=models.Post.ANSWER, root=self.post, parent=self.post)
+
+        auth.Moderate(user=self.owner, post=self.post, action=const.CLOSE)
+        hidden = models.Post.objects.filter(root=self.post, is_visible=True)
+        self.assertFalse(hidden.exists(), "Posts of a closed thread are visible.")
+        self.assertFalse(models.Post.objects.valid_posts(id=answer.id).exists())
+
+        auth.Moderate(user=self.owner, post=self.post, action=const.OPEN_POST)
+        self.assertTrue(models.Post.objects.valid_posts(id=answer.id).exists())
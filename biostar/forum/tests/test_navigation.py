@@ -1,9 +1,12 @@
 import logging, os
 from django.test import TestCase
 from django.test import Client
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.core import management
-from biostar.forum import auth, models
-from biostar.accounts.models import User
+from biostar.forum import auth, models, views
+from biostar.accounts.models import User, Profile
 from biostar.forum.models import Badge
 
 from django.urls import reverse
@@ -71,5 +74,102 @@ class ForumNavigation(TestCase):
 
         self.visit_urls(urls, [200])
 
+    def test_cursor_pages(self):
+        "Checking cursor pages walk the listing in both directions"
+
+        for index in range(5):
+            models.Post.objects.create(title=f"Test {index}", author=self.owner, content="Test",
+                                       type=models.Post.QUESTION)
+
+        # Equal ranks are ordered by id.
+        posts = models.Post.objects.filter(is_toplevel=True)
+        models.Post.objects.filter(pk__in=list(posts.values_list("pk", flat=True)[:3])).update(rank=1)
+        posts = posts.order_by("-rank", "-pk")
+        expected = list(posts.values_list("pk", flat=True))
+        self.assertGreater(len(expected), 2)
+        paginator = views.CursorPaginator(object_list=posts, ordering="-rank", per_page=2)
+
+        # Walk forward through every page.
+        seen, page = [], paginator.get_page()
+        seen.extend(post.pk for post in page)
+        while page.has_next:
+            page = paginator.get_page(after=page.next_cursor)
+            seen.extend(post.pk for post in page)
+        self.assertEqual(seen, expected)
+
+        # Walk back to the first page.
+        seen = [post.pk for post in page]
+        while page.has_previous:
+            page = paginator.get_page(before=page.previous_cursor)
+            seen = [post.pk for post in page] + seen
+        self.assertEqual(seen, expected)
+
+        # Cursors and numbered pages both render.
+        first = paginator.get_page()
+        urls = [
+            reverse("post_list") + f"?after={first.next_cursor}",
+            reverse("post_list") + "?page=2",
+            reverse("post_list") + "?after=invalid",
+            reverse("community_list") + "?order=reputation",
+        ]
+        self.visit_urls(urls, [200])
 
-
+    def test_cursor_empty_values(self):
+        "Checking cursor pages include users that never logged in"
+
+        users = [User.objects.create(username=f"visitor{index}", email=f"visitor{index}@tested.com")
+                 for index in range(5)]
+
+        # Users that never logged in have no last login date.
+        Profile.objects.filter(user__in=users[:3]).update(last_login=None)
+
+        users = User.objects.select_related("profile")
+        expected = set(users.values_list("pk", flat=True))
+
+        for ordering in ("-profile__last_login", "profile__last_login"):
+            paginator = views.CursorPaginator(object_list=users, ordering=ordering, per_page=2)
+
+            # Walk forward through every page.
+            seen, page = [], paginator.get_page()
+            seen.extend(user.pk for user in page)
+            while page.has_next:
+                page = paginator.get_page(after=page.next_cursor)
+                seen.extend(user.pk for user in page)
+            self.assertEqual(len(seen), len(expected), f"Users skipped or repeated ordering by {ordering}.")
+            self.assertEqual(set(seen), expected)
+
+            # Walk back to the first page.
+            back = [user.pk for user in page]
+            while page.has_previous:
+                page = paginator.get_page(before=page.previous_cursor)
+                back = [user.pk for user in page] + back
+            self.assertEqual(back, seen)
+
+        self.visit_urls([reverse("community_list") + "?order=visit"], [200])
+
+    def test_cached_listing(self):
+        "Checking anonymous listings are cached until a post rank changes"
+        cache.clear()
+
+        first = views.listing_ids(show="", tag="", order="rank", limit="all", size=10)
+        with CaptureQueriesContext(connection) as context:
+            second = views.listing_ids(show="", tag="", order="rank", limit="all", size=10)
+        self.assertEqual(first, second)
+        # Only the shared listing version is read from the database.
+        self.assertEqual(len(context.captured_queries), 1, "Cached listing queried the database.")
+
+        # New posts move the listings to a new version.
+        post = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                          type=models.Post.QUESTION)
+        ids = views.listing_ids(show="", tag="", order="rank", limit="all", size=10)
+        self.assertEqual(ids[0], post.id)
+
+        # Other processes see the new version without sharing this cache.
+        version = auth.listing_version()
+        cache.clear()
+        self.assertEqual(auth.listing_version(), version)
+        auth.bump_listings()
+        self.assertEqual(auth.listing_version(), version + 1)
+
+        resp = Client().get(reverse("post_list"))
+        self.assertEqual(resp.context["posts"][0], post)
@@ -44,6 +44,7 @@ forum_patterns = [
     path('ajax/comment/create/', ajax.ajax_comment_create, name='ajax_comment_create'),
     path('inplace/form/', ajax.inplace_form, name='inplace_form'),
     path('ajax/user/image/<str:username>/', ajax.user_image, name='user_image'),
+    path('ajax/users/', ajax.find_users, name='find_users'),
     path('similar/posts/<str:uid>/', ajax.similar_posts, name='similar_posts'),
     path('ajax/report/spam/<str:post_uid>/', ajax.report_spam, name='report_spam'),
     path('release/<str:uid>/', ajax.release_suspect, name='release_suspect'),
@@ -1,5 +1,7 @@
+import base64
+import json
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 from functools import wraps, lru_cache
 import os
 
@@ -8,11 +10,13 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import AnonymousUser
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.core.paginator import Paginator
-from django.db.models import Count, Q
+from django.db.models import Count, F, Q
 from taggit.models import Tag
 from django.shortcuts import render, redirect, reverse
+from django.template.loader import render_to_string
 from django.core.cache import cache
 
 from biostar.accounts.models import Profile
@@ -134,6 +138,34 @@ def get_posts(user, show="latest", tag="", order="rank", limit=None):
     return query
 
 
+def hydrate(ids):
+    """
+    Returns the posts with the given ids in the same order, loaded with one query.
+    """
+    posts = Post.objects.select_related("root").prefetch_related("author__profile", "lastedit_user__profile")
+    posts = posts.in_bulk(ids)
+    return [posts[pk] for pk in ids if pk in posts]
+
+
+def listing_ids(show, tag, order, limit, size):
+    """
+    Returns the ordered ids of the first posts in a listing shown to anonymous users.
+    Cached until the rank or visibility of a post changes.
+    """
+    version = auth.listing_version()
+    key = f"{LISTING_CACHE_KEY}-{version}-{generate_cache_key(show, tag, order, limit, size)}"
+
+    ids = cache.get(key)
+    if ids is None:
+        posts = get_posts(user=AnonymousUser(), show=show, tag=tag, order=order, limit=limit)
+        paginator = CursorPaginator(object_list=posts, ordering=ORDER_MAPPER.get(order) or "-rank",
+                                    per_page=settings.POSTS_PER_PAGE)
+        ids = list(paginator.ordered().prefetch_related(None).values_list("id", flat=True)[:size])
+        cache.set(key, ids, settings.LISTING_CACHE_SECS)
+
+    return ids
+
+
 def post_search(request):
 
     query = request.GET.get('query', '')
@@ -144,7 +176,7 @@ def post_search(request):
         messages.error(request, "Enter more characters before preforming search.")
         return redirect(reverse('post_list'))
 
-    results = search.preform_whoosh_search(query=query, page=page, sortedby=["lastedit_date"])
+    results = search.search_page(query=query, page=page, sortedby=["lastedit_date"])
 
     #if not len(results):
     #    results = search.SearchResult()
@@ -196,6 +228,130 @@ class CachedPaginator(Paginator):
         return value
 
 
+class CursorPage(list):
+    """
+    A page of objects with the cursors that lead to the neighbouring pages.
+    """
+
+    def __init__(self, objs, has_previous, has_next, encode):
+        super(CursorPage, self).__init__(objs)
+        self.has_previous = has_previous and bool(objs)
+        self.has_next = has_next and bool(objs)
+        self.previous_cursor = encode(objs[0]) if self.has_previous else ""
+        self.next_cursor = encode(objs[-1]) if self.has_next else ""
+
+
+class CursorPaginator:
+    """
+    Paginator that seeks past the last object of the previous page instead of using an offset.
+    The cursor holds the ordering value and the id of that object,
+    so every page costs the same query no matter how deep it is.
+    """
+
+    def __init__(self, object_list, ordering, per_page):
+        self.object_list = object_list
+        self.field = ordering.lstrip("-")
+        self.descending = ordering.startswith("-")
+        self.per_page = per_page
+
+    def value(self, obj):
+        # Follow the related lookups to the ordering value.
+        for name in self.field.split("__"):
+            obj = getattr(obj, name)
+        return obj
+
+    def encode(self, obj):
+        value = self.value(obj)
+        value = value.isoformat() if isinstance(value, datetime) else value
+        data = json.dumps([value, obj.pk]).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("ascii")
+
+    def decode(self, cursor):
+        """
+        Returns the value and id stored in the cursor, None when it is not valid.
+        """
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return value, int(pk)
+        except Exception as exc:
+            logger.warning(f"Invalid page cursor: {cursor}")
+            return None
+
+    def ordered(self, forward=True):
+        """
+        Returns the objects ordered by the field and the id in the given direction.
+        Empty values sort below all others on every database.
+        """
+        descending = self.descending if forward else not self.descending
+        sign = "-" if descending else ""
+        if descending:
+            field = F(self.field).desc(nulls_last=True)
+        else:
+            field = F(self.field).asc(nulls_first=True)
+        return self.object_list.order_by(field, f"{sign}pk")
+
+    def seek(self, position, forward):
+        """
+        Returns the objects ordered from the position onwards in the given direction.
+        """
+        descending = self.descending if forward else not self.descending
+        query = self.ordered(forward=forward)
+
+        if position:
+            value, pk = position
+            op = "lt" if descending else "gt"
+            empty = Q(**{f"{self.field}__isnull": True})
+            filled = Q(**{f"{self.field}__isnull": False})
+            if value is None:
+                # Empty values come last going down and first going up.
+                past = empty & Q(**{f"pk__{op}": pk})
+                past = past if descending else past | filled
+            else:
+                past = Q(**{f"{self.field}__{op}": value}) | Q(**{self.field: value, f"pk__{op}": pk})
+                past = past | empty if descending else past
+            query = query.filter(past)
+
+        return list(query[:self.per_page + 1])
+
+    def get_page(self, after=None, before=None):
+        """
+        Returns the page that follows the 'after' cursor or precedes the 'before' cursor.
+        """
+        position = self.decode(before) if before else None
+        if position:
+            objs = self.seek(position, forward=False)
+            more = len(objs) > self.per_page
+            objs = objs[:self.per_page][::-1]
+            return CursorPage(objs, has_previous=more, has_next=True, encode=self.encode)
+
+        position = self.decode(after) if after else None
+        objs = self.seek(position, forward=True)
+        more = len(objs) > self.per_page
+        objs = objs[:self.per_page]
+        return CursorPage(objs, has_previous=bool(position), has_next=more, encode=self.encode)
+
+    def get_cached_page(self, ids, complete, after=None, before=None):
+        """
+        Returns the page sliced from a list of ordered ids, None when the page is not within the list.
+        complete : the list holds every id of the listing.
+        """
+        start, end = 0, self.per_page
+
+        if after or before:
+            position = self.decode(before or after)
+            if not position or position[1] not in ids:
+                return None
+            index = ids.index(position[1])
+            start, end = (max(index - self.per_page, 0), index) if before else (index + 1, index + 1 + self.per_page)
+
+        # The next page can not be known past the end of a partial list.
+        if end >= len(ids) and not complete:
+            return None
+
+        objs = hydrate(ids[start:end])
+        return CursorPage(objs, has_previous=start > 0, has_next=end < len(ids), encode=self.encode)
+
+
 def pages(request, fname):
 
     # Add markdown file extension to markdown
@@ -225,7 +381,9 @@ def post_list(request, show=None, cache_key='', extra_context=dict()):
     user = request.user
 
     # Parse the GET parameters for filtering information
-    page = request.GET.get('page', 1)
+    page = request.GET.get('page')
+    after = request.GET.get('after')
+    before = request.GET.get('before')
     order = request.GET.get("order", "rank")
     tag = request.GET.get("tag", "")
     show = show or request.GET.get("type", "")
@@ -233,22 +391,43 @@ def post_list(request, show=None, cache_key='', extra_context=dict()):
 
     # Pages are enable when showing 'all' ordered by 'rank'
     cond1 = limit == 'all' and order == 'rank'
-    # Pages are also enabled when a page number is provided.
-    cond2 = request.GET.get('page') is not None
+    # Pages are also enabled when a page number or cursor is provided.
+    cond2 = page is not None or after is not None or before is not None
 
     enable_pages = cond1 or cond2
 
+    # Cursor pages are ordered by the field and the id.
+    ordering = ORDER_MAPPER.get(order) or "-rank"
+
     # Get posts available to users.
     posts = get_posts(user=user, show=show, tag=tag, order=order, limit=limit)
 
-    if enable_pages:
-        # Show top 100 posts without pages.
+    # Anonymous users share the cached ids of the first pages.
+    cached = None
+    if user.is_anonymous and page is None:
+        size = max(settings.LISTING_CACHE_PAGES * settings.POSTS_PER_PAGE, 100) + 1
+        ids = listing_ids(show=show, tag=tag, order=order, limit=limit, size=size)
+        complete = len(ids) < size
+        if enable_pages:
+            paginator = CursorPaginator(object_list=posts, ordering=ordering, per_page=settings.POSTS_PER_PAGE)
+            cached = paginator.get_cached_page(ids, complete=complete, after=after, before=before)
+        else:
+            cached = hydrate(ids[:100])
+
+    if cached is not None:
+        posts = cached
+    elif enable_pages and page is not None:
+        # Numbered pages are kept working for existing links.
         cache_key = cache_key or generate_cache_key(limit, tag, show)
         # Create the paginator
         paginator = CachedPaginator(count_key=cache_key, object_list=posts,
                                     per_page=settings.POSTS_PER_PAGE)
         # Apply the post paging.
         posts = paginator.get_page(page)
+    elif enable_pages:
+        # Seek to the page from the cursor in the url.
+        paginator = CursorPaginator(object_list=posts, ordering=ordering, per_page=settings.POSTS_PER_PAGE)
+        posts = paginator.get_page(after=after, before=before)
     else:
         posts = posts[:100]
 
@@ -355,7 +534,9 @@ def mytags(request):
 
 def community_list(request):
     users = User.objects.select_related("profile")
-    page = request.GET.get("page", 1)
+    page = request.GET.get("page")
+    after = request.GET.get('after')
+    before = request.GET.get('before')
     ordering = request.GET.get("order", "visit")
     limit_to = request.GET.get("limit", "time")
     query = request.GET.get('query', '')
@@ -371,14 +552,19 @@ def community_list(request):
                    Q(profile__uid__contains=query)
         users = users.filter(db_query)
 
-    order = ORDER_MAPPER.get(ordering, "visit")
+    order = ORDER_MAPPER.get(ordering) or ORDER_MAPPER["visit"]
     users = users.filter(profile__state__in=[Profile.NEW, Profile.TRUSTED])
     users = users.order_by(order)
 
-    # Create the paginator
-    paginator = CachedPaginator(count_key="USERS", object_list=users,
-                                per_page=settings.POSTS_PER_PAGE)
-    users = paginator.get_page(page)
+    if page is not None:
+        # Numbered pages are kept working for existing links.
+        paginator = CachedPaginator(count_key="USERS", object_list=users,
+                                    per_page=settings.POSTS_PER_PAGE)
+        users = paginator.get_page(page)
+    else:
+        # Seek to the page from the cursor in the url.
+        paginator = CursorPaginator(object_list=users, ordering=order, per_page=settings.POSTS_PER_PAGE)
+        users = paginator.get_page(after=after, before=before)
     context = dict(tab="community", users=users, query=query, order=ordering, limit=limit_to)
 
     return render(request, "community_list.html", context=context)
@@ -434,12 +620,21 @@ def post_view(request, uid):
             return redirect(answer.get_absolute_url())
         messages.error(request, form.errors)
 
-    # Build the comment tree .
-    root, comment_tree, answers, thread = auth.post_tree(user=request.user, root=post.root)
-    # user string
-    users_str = auth.get_users_str()
+    # Anonymous users share the rendered thread.
+    root = post.root
+    key = auth.thread_key(root=root, user=request.user)
+    html = cache.get(key) if key else None
+
+    if html is None:
+        # Build the comment tree .
+        root, comment_tree, answers, thread = auth.post_tree(user=request.user, root=root)
+        context = dict(post=root, tree=comment_tree, answers=answers)
+        html = render_to_string("widgets/post_thread.html", context=context, request=request)
+
+        if key:
+            cache.set(key, html, settings.THREAD_CACHE_SECS)
 
-    context = dict(post=root, tree=comment_tree, form=form, answers=answers, users_str=users_str)
+    context = dict(post=root, thread=html, form=form)
 
     return render(request, "post_view.html", context=context)
 
@@ -472,9 +667,8 @@ def new_post(request):
 
     # Action url for the form is the current view
     action_url = reverse("post_create")
-    users_str = auth.get_users_str()
     context = dict(form=form, tab="new", tag_val=tag_val, action_url=action_url,
-                   content=content, users_str=users_str)
+                   content=content)
 
     return render(request, "new_post.html", context=context)
 
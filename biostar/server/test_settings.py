@@ -5,3 +5,6 @@ MULTI_THREAD = False
 
 # Skip hitting the spam indexe when creating test posts
 CLASSIFY_SPAM = False
+
+# Write post views to the database right away.
+POST_VIEW_FLUSH_SECS = 0
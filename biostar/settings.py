@@ -18,6 +18,16 @@ MULTI_THREAD = True
 # A setting to disable tasks altoghether.
 DISABLE_TASKS = False
 
+# Threads running tasks when UWSGI is not installed.
+TASK_WORKERS = 4
+
+# Tasks waiting for a thread before new tasks block the caller.
+TASK_QUEUE_SIZE = 100
+
+# Function that stores spooled tasks when UWSGI is not installed, empty runs them in threads.
+# Set to "biostar.forum.queue.enqueue" to keep tasks in the database for the worker command.
+TASK_QUEUE = ""
+
 # Pagedown
 PAGEDOWN_IMAGE_UPLOAD_ENABLED = False
 
@@ -288,6 +288,9 @@ def bulk_copy_posts(limit):
     Post.objects.bulk_update(objs=set_counts(), fields=["reply_count", "comment_count", "answer_count"], batch_size=1000)
     elapsed(f"Set {pcount} post counts.")
 
+    Post.objects.update_visibility()
+    elapsed(f"Set {pcount} post visibility.")
+
     Award.objects.bulk_create(objs=gen_awards(), batch_size=10000)
     acount = Award.objects.all().count()
     elapsed(f"transferred {acount} awards")
@@ -1,12 +1,115 @@
 import logging, functools
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
 logger = logging.getLogger('biostar')
 import threading
 
+# Counters for each task run by the threaded spooler.
+STATS = defaultdict(lambda: dict(queued=0, running=0, done=0, failed=0, latency=0.0))
+STATS_LOCK = threading.Lock()
+
+# Timers declared when UWSGI is not installed, run from the database queue by the worker command.
+TIMERS = []
+
+# Thread pool shared by the spooled tasks, created on first use.
+POOL = dict(executor=None, slots=None)
+POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the executor that runs spooled tasks and the semaphore that bounds its queue.
+    """
+    with POOL_LOCK:
+        if POOL['executor'] is None:
+            workers = settings.TASK_WORKERS
+            POOL['executor'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="spool")
+            # One slot per running or queued task, callers wait when all slots are taken.
+            POOL['slots'] = threading.BoundedSemaphore(workers + settings.TASK_QUEUE_SIZE)
+    return POOL['executor'], POOL['slots']
+
+
+def count(name, **changes):
+    with STATS_LOCK:
+        stats = STATS[name]
+        for key, value in changes.items():
+            stats[key] += value
+
+
+def task_stats():
+    """
+    Returns the counters of each spooled task.
+    The latency is the average seconds from queueing a task to finishing it.
+    """
+    with STATS_LOCK:
+        result = dict()
+        for name, stats in STATS.items():
+            finished = stats['done'] + stats['failed']
+            result[name] = dict(stats, latency=stats['latency'] / finished if finished else 0.0)
+        return result
+
+
+def run_task(func, queued, args, kwargs):
+    """
+    Runs a spooled task in a pool thread.
+    """
+    name = func.__name__
+    count(name, queued=-1, running=1)
+    try:
+        func(*args, **kwargs)
+        count(name, done=1)
+    except Exception as exc:
+        count(name, failed=1)
+        logger.error(f"task {name} failed: {exc}")
+    finally:
+        count(name, running=-1, latency=time.time() - queued)
+        # Pool threads are reused, close the connections the task opened.
+        connections.close_all()
+
+
+def submit(func, *args, **kwargs):
+    """
+    Queues a task on the pool, blocks while the queue is full.
+    """
+    executor, slots = get_pool()
+    slots.acquire()
+    count(func.__name__, queued=1)
+    try:
+        future = executor.submit(run_task, func, time.time(), args, kwargs)
+    except Exception:
+        count(func.__name__, queued=-1)
+        slots.release()
+        raise
+    future.add_done_callback(lambda future: slots.release())
+    return future
+
+
+def task_options(priority=0, key=None):
+    """
+    Sets how a spooled task is stored in the database queue.
+    Tasks with higher priority run first, key is called with the task arguments
+    and a task is not queued again while one with the same key is waiting.
+    """
+    def outer(func):
+        func.queue_priority = priority
+        func.queue_key = key
+        return func
+    return outer
+
 try:
     # When run with uwsgi the tasks will be spooled via uwsgi.
     from uwsgidecorators import spool, timer
 
+    def timers_running():
+        """
+        True when the declared timers run on their own.
+        """
+        return True
+
 except Exception as exc:
     #
     # With no uwsgi module the tasks will be spooled.
@@ -15,6 +118,12 @@ except Exception as exc:
 
     logger.warning("uwsgi module not found, tasks will run in threads")
 
+    def timers_running():
+        """
+        True when the declared timers run, without uwsgi the worker command runs them.
+        """
+        return bool(settings.TASK_QUEUE) and not settings.DISABLE_TASKS
+
     # Create a threaded version of the spooler
     def spool(pass_arguments=True):
         def outer(func):
@@ -22,11 +131,13 @@ except Exception as exc:
             def inner(*args, **kwargs):
                 if settings.DISABLE_TASKS:
                     return
+                if settings.TASK_QUEUE:
+                    # Store the task for the worker command.
+                    enqueue = import_string(settings.TASK_QUEUE)
+                    return enqueue(func, args=args, kwargs=kwargs)
                 if settings.MULTI_THREAD:
-                    # Run process in separate thread.
-                    logger.info(f"new thread for function f{func} {args} {kwargs}")
-                    t = threading.Thread(target=func, args=args, kwargs=kwargs, daemon=True)
-                    t.start()
+                    # Run process in the bounded thread pool.
+                    return submit(func, *args, **kwargs)
                 else:
                     func(*args, **kwargs)
             inner.spool = inner
@@ -35,28 +146,21 @@ except Exception as exc:
         return outer
 
     # Create a threaded version of the timer
-    def timer(secs, **kwargs):
+    def timer(secs, target=None, **kwargs):
         def outer(func):
             @functools.wraps(func)
             def inner(*args, **kwargs):
                 if settings.DISABLE_TASKS:
                     return
 
-                # The loop repeats the timer.
-                def loop():
-                    ticker = threading.Event()
-                    while not ticker.wait(secs):
-                        func(*args, **kwargs)
-
-                if settings.MULTI_THREAD:
-                    # Run process in separate thread, once.
-                    logger.info(f"new time thread for function f{func} {args} {kwargs}")
-                    t = threading.Thread(target=loop, daemon=True)
-                    t.start()
-                else:
-                    func(*args, **kwargs)
+                # Calls run once, the worker command repeats the timer.
+                func(*args, **kwargs)
 
             inner.timer = inner
+
+            # Run by the worker command, never when declared or called.
+            TIMERS.append((secs, func, target))
+
             return inner
         # Gains an attribute called timer that will run the function periodically.
         return outer